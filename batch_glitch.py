@@ -0,0 +1,228 @@
+"""
+Run a filter chain over many images at once using a pool of worker
+processes. Each worker creates its own headless opengl context and compiles
+the filters once, then filters every image it is handed.
+
+usage: python batch_glitch.py INPUT OUTPUT_DIR -f first -f rgb_shift
+
+INPUT is either a folder of images or a manifest file with one image path
+per line.
+
+With --frames N, INPUT is a single image and frames 0 to N - 1 of its
+animation are split into ranges rendered by the workers, then written in
+order as numbered pngs in OUTPUT_DIR, or encoded by ffmpeg if OUTPUT_DIR
+is a video file name. Every frame's rand comes from (seed, frame, filter),
+so the result is the same as recording it in a single process.
+"""
+import argparse
+import multiprocessing
+import os
+
+import headless
+headless.setup_platform()
+
+from PIL import Image
+from recording import PngSink, EncoderSink, FrameWriter
+from seeds import DEF_SEED
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tga', '.tif',
+                    '.tiff', '.webp')
+
+VIDEO_EXTENSIONS = ('.webm', '.mp4', '.mkv', '.avi', '.mov')
+
+# Frames a worker renders per job when rendering an animation
+DEF_CHUNK_FRAMES = 8
+
+DEF_FPS = 30
+
+# Set by init_worker, each worker process keeps one for its whole life
+worker_glitch = None
+
+worker_filters = []
+
+# Image the worker's chain was last loaded with, animation jobs reuse it
+worker_image_path = None
+
+
+def init_worker(filters):
+    """
+    Create the worker's gl context and filters. llvmpipe spawns its own
+    render threads, limit those to one per worker so processes scale with
+    cores instead of fighting over them.
+    """
+    global worker_glitch, worker_filters
+    os.environ.setdefault('LP_NUM_THREADS', '1')
+    from image_glitch import ImageGlitch
+    worker_glitch = ImageGlitch(headless=True)
+    # Each frame is rendered once, keeping them on the gpu is wasted memory,
+    # same for the targets of image sizes that may never come up again
+    worker_glitch.frame_ring.set_budget(0)
+    worker_glitch.target_pool.set_budget(0)
+    worker_filters = filters
+
+
+def filter_file(paths):
+    """
+    Filter a single image and save it the same way screenshot does
+    """
+    in_path, out_path = paths
+    try:
+        img = Image.open(in_path)
+    except IOError as e:
+        return in_path, "Could not load image %s: %s" % (in_path, e)
+    global worker_image_path
+    worker_image_path = None
+    worker_glitch.frame = 0
+    try:
+        # PIL decodes lazily, truncated or corrupt images fail in here
+        worker_glitch.filter_img(img, worker_filters)
+        worker_glitch.screenshot(out_path)
+    except Exception as e:
+        return in_path, "Could not filter image %s: %s" % (in_path, e)
+    finally:
+        img.close()
+    errors = worker_glitch.wait_for_writes()
+    if errors:
+        return in_path, "Could not save %s: %s" % (out_path, errors[0])
+    return in_path, None
+
+
+def render_frames(job):
+    """
+    Render frames first to last - 1 of an image's animation, returns first
+    and the frames as bottom up pixels. Frames are read back through the
+    readback ring, so the next frame renders while the last one copies.
+    """
+    global worker_image_path
+    in_path, seed, first, last = job
+    if worker_image_path != in_path:
+        img = Image.open(in_path)
+        worker_glitch.filter_img(img, worker_filters)
+        img.close()
+        worker_image_path = in_path
+    worker_glitch.seed = seed
+    finished = []
+    for frame in range(first, last):
+        worker_glitch.frame = frame
+        worker_glitch.update_filtered_image(update_frame_count=False)
+        finished += worker_glitch.queue_readback(frame)
+    finished += worker_glitch.flush_readback()
+    return first, [pixels for frame, pixels in finished]
+
+
+def get_input_paths(target):
+    """
+    Returns image paths from a folder or from a manifest with a path per line
+    """
+    if os.path.isdir(target):
+        return sorted(os.path.join(target, name)
+                      for name in os.listdir(target)
+                      if name.lower().endswith(IMAGE_EXTENSIONS))
+    with open(target) as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.startswith('#')]
+
+
+def get_output_path(in_path, output_dir):
+    name = os.path.splitext(os.path.basename(in_path))[0]
+    return os.path.join(output_dir, "%s.png" % (name))
+
+
+def run_batch(input_paths, output_dir, filters, processes=None):
+    """
+    Spread input_paths over a pool of worker processes, returns a list of
+    (path, error) for any images that failed
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    jobs = [(p, get_output_path(p, output_dir)) for p in input_paths]
+    pool = multiprocessing.Pool(processes, init_worker, (filters,))
+    errors = []
+    try:
+        for num, (path, error) in enumerate(
+                pool.imap_unordered(filter_file, jobs)):
+            if error:
+                errors.append((path, error))
+                print(error)
+            else:
+                print("Saved %s/%s %s" % (num + 1, len(jobs), path))
+    finally:
+        pool.close()
+        pool.join()
+    return errors
+
+
+def run_frames(in_path, output, filters, num_frames, seed=DEF_SEED,
+               fps=DEF_FPS, processes=None, chunk_frames=DEF_CHUNK_FRAMES):
+    """
+    Render num_frames frames of in_path's animation over a pool of worker
+    processes in chunks of chunk_frames, and write them in frame order to
+    pngs in the output folder or to an ffmpeg encoded output video
+    """
+    img = Image.open(in_path)
+    dimensions = img.size
+    img.close()
+    if output.lower().endswith(VIDEO_EXTENSIONS):
+        sink = EncoderSink(output, dimensions, fps)
+    else:
+        sink = PngSink(output)
+    writer = FrameWriter(1 if sink.ordered else 2)
+    jobs = [(in_path, seed, first, min(first + chunk_frames, num_frames))
+            for first in range(0, num_frames, chunk_frames)]
+    pool = multiprocessing.Pool(processes, init_worker, (filters,))
+    try:
+        # imap hands chunks back in job order however the workers finish
+        for first, frames in pool.imap(render_frames, jobs):
+            for i, pixels in enumerate(frames):
+                writer.submit(sink.write_frame, first + i, pixels,
+                              dimensions)
+            print("Rendered %s/%s frames" % (first + len(frames),
+                                            num_frames))
+    finally:
+        pool.close()
+        pool.join()
+        writer.submit(sink.close)
+        writer.close()
+    errors = writer.pop_errors()
+    for error in errors:
+        print(error)
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Filter a folder or manifest of images headlessly")
+    parser.add_argument('input',
+                        help="folder of images or manifest of image paths")
+    parser.add_argument('output_dir')
+    parser.add_argument('-f', '--filter', action='append', dest='filters',
+                        default=[], help="filter name, repeat to chain")
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help="worker processes, defaults to cpu count")
+    parser.add_argument('-n', '--frames', type=int, default=None,
+                        help="render this many frames of a single image")
+    parser.add_argument('--seed', type=int, default=DEF_SEED)
+    parser.add_argument('--fps', type=int, default=DEF_FPS,
+                        help="frame rate of an encoded video")
+    parser.add_argument('--chunk', type=int, default=DEF_CHUNK_FRAMES,
+                        help="frames rendered per worker job")
+    args = parser.parse_args()
+
+    from shader_filters import ALL_FILTERS
+    unknown = [name for name in args.filters if name not in ALL_FILTERS]
+    if unknown:
+        parser.error("Could not find filter %s" % (", ".join(unknown)))
+
+    if args.frames is not None:
+        errors = run_frames(args.input, args.output_dir, args.filters,
+                            args.frames, args.seed, args.fps,
+                            args.processes, args.chunk)
+        return 1 if errors else 0
+
+    errors = run_batch(get_input_paths(args.input), args.output_dir,
+                       args.filters, args.processes)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
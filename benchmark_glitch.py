@@ -0,0 +1,400 @@
+"""
+Headless benchmarks for the filters, some representative chains, reading
+the result back and encoding it, at image sizes from 0.5 to 32 megapixels,
+plus building filter programs with and without the program binary cache
+and loading the console font with and without the raw atlas cache.
+Every measurement is warmed up, repeated and written as JSON so runs on
+different commits or machines can be compared.
+
+usage: python benchmark_glitch.py [-m MP ...] [-b gl -b cpu] [-o out.json]
+                                  [--no-encoding] [--no-font]
+                                  [--compare baseline.json]
+
+The stage cache, frame ring and target pool are turned off so every repeat
+renders the whole chain and nothing is kept between image sizes.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import headless
+headless.setup_platform()
+
+from PIL import Image
+from recording import EncoderSink, save_png
+
+DEF_MEGAPIXELS = (0.5, 1, 2, 4, 8, 16, 32)
+
+DEF_BACKENDS = ('gl', 'cpu')
+
+# Chains picked to cover fused runs, unfused multi sample passes and the
+# random filters
+DEF_CHAINS = (
+    ('second', 'third', 'repeat_end'),
+    ('first', 'rgb_shift', 'scanlines'),
+    ('static', 'static2', 'scanlines'),
+    ('first', 'second', 'third', 'rgb_shift', 'repeat_end', 'static',
+     'static2', 'scanlines'),
+)
+
+DEF_WARMUP = 2
+
+DEF_REPEATS = 10
+
+
+def time_ms(func, warmup=DEF_WARMUP, repeats=DEF_REPEATS):
+    """
+    Returns how long each of repeats calls to func took in ms
+    """
+    for i in range(warmup):
+        func()
+    times = []
+    for i in range(repeats):
+        start = time.time()
+        func()
+        times.append((time.time() - start) * 1000.0)
+    return times
+
+
+def summarize(times):
+    ordered = sorted(times)
+    mean = sum(ordered) / float(len(ordered))
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        median = ordered[middle]
+    else:
+        median = (ordered[middle - 1] + ordered[middle]) / 2.0
+    stdev = (sum((t - mean) ** 2 for t in ordered) / len(ordered)) ** 0.5
+    return {
+        "mean": mean,
+        "median": median,
+        "min": ordered[0],
+        "max": ordered[-1],
+        "stdev": stdev,
+        "repeats": len(ordered),
+    }
+
+
+def make_image(megapixels):
+    """
+    Square noise image of about megapixels, noise so nothing compresses or
+    caches better than a real photo would
+    """
+    side = int((megapixels * 1000000) ** 0.5)
+    return Image.frombytes("RGBA", (side, side), os.urandom(side * side * 4))
+
+
+def result(backend, kind, name, megapixels, img, times):
+    return {
+        "backend": backend,
+        "kind": kind,
+        "name": name,
+        "megapixels": megapixels,
+        "dimensions": list(img.size),
+        "ms": summarize(times),
+    }
+
+
+def create_gl_glitch():
+    """
+    Returns a headless ImageGlitch with its caches off, or None if there is
+    no usable gl context
+    """
+    try:
+        from image_glitch import ImageGlitch
+        glitch = ImageGlitch(headless=True)
+    except Exception as e:
+        print("No gl context, skipping gl: %s" % (e))
+        return None
+    glitch.stage_cache.set_budget(0)
+    glitch.frame_ring.set_budget(0)
+    glitch.target_pool.set_budget(0)
+    return glitch
+
+
+def bench_gl(glitch, img, megapixels, chains, warmup, repeats):
+    from OpenGL import GL as gl
+    from shader_filters import ALL_FILTERS
+    results = []
+    max_size = gl.glGetIntegerv(gl.GL_MAX_TEXTURE_SIZE)
+    if max(img.size) > max_size:
+        print("Skipping gl at %s MP, larger than the %s max texture size" % (
+            megapixels, max_size))
+        return results
+
+    def render():
+        glitch.update_filtered_image()
+        gl.glFinish()
+
+    jobs = [("filter", name, [name]) for name in sorted(ALL_FILTERS)]
+    jobs += [("chain", ",".join(chain), list(chain)) for chain in chains]
+    for kind, name, filters in jobs:
+        glitch.filter_img(img, filters)
+        results.append(result("gl", kind, name, megapixels, img,
+                              time_ms(render, warmup, repeats)))
+    # Readback of the last chain, it is already rendered
+    results.append(result("gl", "readback", "get_filter_img", megapixels,
+                          img, time_ms(glitch.get_filter_img, warmup,
+                                       repeats)))
+    return results
+
+
+def bench_cpu(img, megapixels, chains, warmup, repeats):
+    try:
+        from cpu_glitch import CpuImageGlitch, CPU_FILTERS
+    except ImportError as e:
+        print("Skipping cpu: %s" % (e))
+        return []
+    results = []
+    glitch = CpuImageGlitch()
+    jobs = [("filter", name, [name]) for name in sorted(CPU_FILTERS)]
+    jobs += [("chain", ",".join(chain), list(chain)) for chain in chains]
+    for kind, name, filters in jobs:
+        glitch.filter_img(img, filters)
+        results.append(result("cpu", kind, name, megapixels, img,
+                              time_ms(glitch.update_filtered_image, warmup,
+                                      repeats)))
+    return results
+
+
+def bench_encoding(img, megapixels, warmup, repeats):
+    """
+    Time the two recording paths, png per frame and raw frames piped into
+    ffmpeg
+    """
+    results = []
+    pixels = img.tobytes()
+    folder = tempfile.mkdtemp(prefix="glitch_bench")
+    try:
+        filename = os.path.join(folder, "frame.png")
+        results.append(result(
+            "png", "encode", "save_png", megapixels, img,
+            time_ms(lambda: save_png(filename, pixels, img.size), warmup,
+                    repeats)))
+
+        # Frames are buffered by the pipe, so time the whole stream including
+        # closing it and report it per frame
+        try:
+            sink = EncoderSink(os.path.join(folder, "out.webm"), img.size, 30)
+        except OSError as e:
+            print("Skipping ffmpeg: %s" % (e))
+            return results
+        for i in range(warmup):
+            sink.write_frame(i, pixels, img.size)
+        start = time.time()
+        for i in range(repeats):
+            sink.write_frame(warmup + i, pixels, img.size)
+        sink.close()
+        per_frame = (time.time() - start) * 1000.0 / repeats
+        results.append(result("ffmpeg", "encode", sink.codec, megapixels,
+                              img, [per_frame]))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def bench_programs(warmup, repeats):
+    """
+    Time building every filter's program cold, compiled from source with an
+    empty program binary cache, and warm, loaded from the cache
+    """
+    from shader_filters import ALL_FILTERS, program_cache
+    results = []
+    old_dir = program_cache.CACHE_DIR
+    folder = tempfile.mkdtemp(prefix="glitch_bench")
+    program_cache.CACHE_DIR = folder
+    try:
+        if not program_cache.is_supported():
+            print("Skipping program builds, no program binary support")
+            return results
+        for name in sorted(ALL_FILTERS):
+            def build(cold):
+                if cold:
+                    for cached in os.listdir(folder):
+                        os.remove(os.path.join(folder, cached))
+                start = time.time()
+                ALL_FILTERS[name]().cleanup_shader()
+                return (time.time() - start) * 1000.0
+
+            for kind in ("cold", "warm"):
+                for i in range(warmup):
+                    build(kind == "cold")
+                times = [build(kind == "cold") for i in range(repeats)]
+                results.append({
+                    "backend": "gl",
+                    "kind": "program",
+                    "name": "%s %s" % (name, kind),
+                    "megapixels": 0,
+                    "dimensions": [],
+                    "ms": summarize(times),
+                })
+    finally:
+        program_cache.CACHE_DIR = old_dir
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def bench_font(warmup, repeats):
+    """
+    Time getting the console font ready for upload: decoding the png, the
+    raw atlas when it is cached and building the atlas when it isn't
+    """
+    from shader_filters import font_atlas
+    from shader_filters.filter_console import PNG_FONT_PATH
+    size = font_atlas.DEF_FONT_SIZE
+    results = []
+
+    def load_png():
+        img = Image.open(PNG_FONT_PATH)
+        img.convert("RGBA").tobytes("raw", "RGBA", 0, -1)
+        img.close()
+
+    folder = tempfile.mkdtemp(prefix="glitch_bench")
+    path = os.path.join(folder, "font.atlas")
+    try:
+        jobs = [
+            ("png", load_png),
+            ("atlas_build", lambda: font_atlas.build_atlas(
+                path, font_atlas.FONT_PATH, [size])),
+            ("atlas_cached", lambda: font_atlas.get_atlas(size, path)),
+        ]
+        for name, func in jobs:
+            results.append({
+                "backend": "font",
+                "kind": "load",
+                "name": name,
+                "megapixels": 0,
+                "dimensions": [16 * n for n in
+                               font_atlas.cell_dimensions(size)],
+                "ms": summarize(time_ms(func, warmup, repeats)),
+            })
+    except (IOError, OSError, ImportError) as e:
+        print("Skipping font: %s" % (e))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def machine_info(gl_glitch):
+    info = {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "processor": platform.processor(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    if gl_glitch:
+        from OpenGL import GL as gl
+        for key, name in (("gl_vendor", gl.GL_VENDOR),
+                          ("gl_renderer", gl.GL_RENDERER),
+                          ("gl_version", gl.GL_VERSION)):
+            value = gl.glGetString(name)
+            info[key] = value.decode() if isinstance(value, bytes) else value
+    return info
+
+
+def run_suite(megapixels=DEF_MEGAPIXELS, backends=DEF_BACKENDS,
+              chains=DEF_CHAINS, warmup=DEF_WARMUP, repeats=DEF_REPEATS,
+              encoding=True, font=True):
+    """
+    Returns a report dict with the machine and a result per measurement
+    """
+    gl_glitch = create_gl_glitch() if 'gl' in backends else None
+    report = {
+        "machine": machine_info(gl_glitch),
+        "warmup": warmup,
+        "results": [],
+    }
+    try:
+        for mp in megapixels:
+            img = make_image(mp)
+            results = []
+            if gl_glitch:
+                results += bench_gl(gl_glitch, img, mp, chains, warmup,
+                                    repeats)
+            if 'cpu' in backends:
+                results += bench_cpu(img, mp, chains, warmup, repeats)
+            if encoding:
+                results += bench_encoding(img, mp, warmup, repeats)
+            for r in results:
+                print("%-6s %-8s %-24s %6s MP %10.2f ms" % (
+                    r["backend"], r["kind"], r["name"][:24], mp,
+                    r["ms"]["median"]))
+            report["results"] += results
+            img.close()
+        results = []
+        if gl_glitch:
+            results += bench_programs(warmup, repeats)
+        if font:
+            results += bench_font(warmup, repeats)
+        if results:
+            for r in results:
+                print("%-6s %-8s %-24s %10.2f ms" % (
+                    r["backend"], r["kind"], r["name"][:24],
+                    r["ms"]["median"]))
+            report["results"] += results
+    finally:
+        if gl_glitch:
+            gl_glitch.cleanup()
+    return report
+
+
+def result_key(r):
+    return (r["backend"], r["kind"], r["name"], r["megapixels"])
+
+
+def compare(report, baseline):
+    """
+    Print the median of every measurement in both reports and how it
+    changed, returns the (key, ratio) pairs
+    """
+    old = dict((result_key(r), r) for r in baseline["results"])
+    ratios = []
+    print("%-6s %-8s %-24s %6s %10s %10s %8s" % (
+        "", "", "", "MP", "base ms", "ms", "ratio"))
+    for r in report["results"]:
+        key = result_key(r)
+        if key not in old:
+            continue
+        base_ms = old[key]["ms"]["median"]
+        ratio = r["ms"]["median"] / base_ms if base_ms else float('inf')
+        ratios.append((key, ratio))
+        print("%-6s %-8s %-24s %6s %10.2f %10.2f %7.2fx" % (
+            key[0], key[1], key[2][:24], key[3], base_ms,
+            r["ms"]["median"], ratio))
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark filters, chains, readback and encoding")
+    parser.add_argument('-m', '--megapixels', type=float, action='append',
+                        default=[], help="image size, repeat for several")
+    parser.add_argument('-b', '--backend', action='append', dest='backends',
+                        choices=DEF_BACKENDS, default=[])
+    parser.add_argument('-w', '--warmup', type=int, default=DEF_WARMUP)
+    parser.add_argument('-r', '--repeats', type=int, default=DEF_REPEATS)
+    parser.add_argument('--no-encoding', action='store_true')
+    parser.add_argument('--no-font', action='store_true')
+    parser.add_argument('-o', '--output', help="write the report as JSON")
+    parser.add_argument('--compare', help="JSON report to compare against")
+    args = parser.parse_args()
+
+    report = run_suite(args.megapixels or DEF_MEGAPIXELS,
+                       args.backends or DEF_BACKENDS, DEF_CHAINS,
+                       args.warmup, args.repeats, not args.no_encoding,
+                       not args.no_font)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
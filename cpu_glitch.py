@@ -0,0 +1,381 @@
+"""
+NumPy versions of the filters in shader_filters, for machines without a
+usable opengl driver and as a reference that is not a gpu rasterizer.
+
+Every filter works on whole arrays the same way its shader works on one
+fragment. Textures are kept bottom up like the gl textures, as float32 RGBA
+in [0, 1], and sampled with GL_NEAREST / GL_REPEAT rules. The static filters
+index the same noise pool the shaders sample, static2's band key goes
+through cos so it can differ from a gpu where cos rounds differently.
+
+usage: python cpu_glitch.py [MP ...]  (benchmarks cpu against gl, by default
+at 1, 4 and 16 MP, 8.3 MP is 4K)
+"""
+import time
+import numpy as np
+from PIL import Image
+from recording import pixels_to_image, save_png
+from seeds import (DEF_SEED, frame_rand, generate_noise, NOISE_POOL_SIZE,
+                   NOISE_POOL_LAYERS, NOISE_POOL_SEED)
+
+F32 = np.float32
+
+# glClearColor(0.6, 0.6, 0.6, 0.0) as stored in an 8 bit framebuffer
+CLEAR_COLOR = np.array([153.0 / 255.0] * 3 + [0.0], dtype=F32)
+
+# The noise pool as (layer, y, x) float32, made on first use
+noise_texels = None
+
+# Set through set_noise_pool, the same as noise_pool's on the gl side
+noise_pool = (NOISE_POOL_SIZE, NOISE_POOL_LAYERS, NOISE_POOL_SEED)
+
+
+def _coords(tex):
+    """
+    Integer fragment coordinates shaped to broadcast over the texture
+    """
+    h, w = tex.shape[:2]
+    x = np.arange(w, dtype=np.int64)[np.newaxis, :]
+    y = np.arange(h, dtype=np.int64)[:, np.newaxis]
+    return x, y
+
+
+def _sub_pixel(tex):
+    h, w = tex.shape[:2]
+    return F32(1.0) / F32(w) / F32(1000), F32(1.0) / F32(h) / F32(1000)
+
+
+def _sample(tex, u, v):
+    """
+    texture() with GL_NEAREST filtering and GL_REPEAT wrapping
+    """
+    h, w = tex.shape[:2]
+    i = np.floor(np.asarray(u, dtype=F32) * F32(w)).astype(np.int64) % w
+    j = np.floor(np.asarray(v, dtype=F32) * F32(h)).astype(np.int64) % h
+    i, j = np.broadcast_arrays(i, j)
+    return tex[j, i]
+
+
+def _noise_at(co_x, co_y, rand):
+    """
+    noise_at from shader_filters/noise_pool.py, rand picks the layer and
+    offset, the integer coordinates wrap around the pool
+    """
+    global noise_texels
+    if noise_texels is None:
+        size, layers, seed = noise_pool
+        # GL_R16 texels, read in native byte order like GL_UNSIGNED_SHORT
+        noise_texels = (np.frombuffer(
+            generate_noise(size, layers, seed), dtype=np.uint16).reshape(
+            layers, size, size).astype(F32) / F32(65535.0))
+    layers, size = noise_texels.shape[:2]
+    seed = int(F32(rand) * F32(16777216.0))
+    i = (np.asarray(co_x, dtype=np.int64) + seed % size) % size
+    j = (np.asarray(co_y, dtype=np.int64) + (seed // size) % size) % size
+    i, j = np.broadcast_arrays(i, j)
+    return noise_texels[seed % layers][j, i]
+
+
+def _add_target(i, target, width, height, step):
+    """
+    Closed form of the add_target loop of the row shifting filters, the
+    number of steps taken is ceil((i - target) / (width + step)) capped at
+    height
+    """
+    d = i - target
+    steps = np.minimum(height, (d + width + step - 1) // (width + step))
+    return np.where(d > 0, i - step * steps, i)
+
+
+def _rgba(r, g, b, a):
+    r, g, b, a = np.broadcast_arrays(*[np.asarray(c, dtype=F32)
+                                       for c in (r, g, b, a)])
+    return np.stack([r, g, b, a], axis=-1)
+
+
+def first(tex, frame, rand):
+    h, w = tex.shape[:2]
+    x, y = _coords(tex)
+    sub_x, sub_y = _sub_pixel(tex)
+    frame_f = F32(frame)
+    i = x + (h - y) * w
+
+    shift = int(np.cos(frame_f * np.cos(frame_f / F32(3.9)) /
+                       F32(20.0)) * F32(10.0))
+    i = _add_target(i, h // 7 * w - w * 20 + shift * w, w, 20, 3)
+    if F32(rand) < F32(0.1):
+        shift = int(np.sin(frame_f / F32(30.0)) * F32(20.0))
+        i = _add_target(i, h // 3 * w - w * 20 + shift * w, w, 15, 3)
+
+    u = sub_x + (i % w).astype(F32) / F32(w)
+    v = sub_y + (F32(1.0) - (i // w).astype(F32) / F32(h))
+    return _sample(tex, u, v)
+
+
+def second(tex, frame, rand):
+    color = tex.copy()
+    color[..., :3] = F32(1.0) - tex[..., :3]
+    return color
+
+
+def third(tex, frame, rand):
+    h, w = tex.shape[:2]
+    x, y = _coords(tex)
+    coord_x = x.astype(F32) + F32(0.5)
+    coord_y = y.astype(F32) + F32(0.5)
+    coord_x = coord_x + np.cos(coord_x * F32(0.05)) * F32(20.0)
+    coord_y = coord_y + np.sin(coord_y * F32(0.05)) * F32(20.0)
+    return _sample(tex, coord_x / F32(w), coord_y / F32(h))
+
+
+def rgb_shift(tex, frame, rand):
+    h, w = tex.shape[:2]
+    x, y = _coords(tex)
+    sub_x, sub_y = _sub_pixel(tex)
+    frame_f = F32(frame)
+    r_offset = int(np.cos(np.cos(frame_f / F32(2.0)) * F32(20)) * F32(6.0))
+    b_offset = int(-np.cos(frame_f / F32(16.0)) * F32(6.0))
+
+    # coord is flipped in x, then the tex coord is flipped back
+    coord_x = -x
+    v = sub_y + y.astype(F32) / F32(h)
+    u_r = -(sub_x + (coord_x - r_offset).astype(F32) / F32(w))
+    u_g = -(sub_x + coord_x.astype(F32) / F32(w))
+    u_b = -(sub_x + (coord_x + b_offset).astype(F32) / F32(w))
+    return _rgba(_sample(tex, u_r, v)[..., 0],
+                 _sample(tex, u_g, v)[..., 1],
+                 _sample(tex, u_b, v)[..., 2], 1.0)
+
+
+def repeat_end(tex, frame, rand):
+    h, w = tex.shape[:2]
+    x, y = _coords(tex)
+    sub_x, sub_y = _sub_pixel(tex)
+    y = np.maximum(y, h // 6)
+    return _sample(tex, x.astype(F32) / F32(w) + sub_x,
+                   y.astype(F32) / F32(h) + sub_y)
+
+
+def static(tex, frame, rand):
+    h, w = tex.shape[:2]
+    x, y = _coords(tex)
+    sub_x, sub_y = _sub_pixel(tex)
+    cell_x = (x.astype(F32) / F32(120)).astype(np.int64)
+    cell_y = (y.astype(F32) / F32(3)).astype(np.int64)
+    noise = (_noise_at(cell_x, cell_y, rand) * F32(80)).astype(np.int64) == 4
+
+    c = _noise_at((F32(3.14) + x.astype(F32) / F32(120)).astype(np.int64),
+                (F32(3.14) + y.astype(F32) / F32(3)).astype(np.int64), rand)
+    static_color = _rgba(c, c, c, 1.0)
+    tex_color = _sample(tex, sub_x + x.astype(F32) / F32(w),
+                        sub_y + y.astype(F32) / F32(h))
+    return np.where(noise[..., np.newaxis], static_color, tex_color)
+
+
+def static2(tex, frame, rand):
+    h, w = tex.shape[:2]
+    x, y = _coords(tex)
+    sub_x, sub_y = _sub_pixel(tex)
+    tex_color = _sample(tex, sub_x + x.astype(F32) / F32(w),
+                        sub_y + y.astype(F32) / F32(h))
+
+    divisor = (F32(100) * np.cos(np.cos(y.astype(F32) / F32(3.0)))).astype(
+        np.int64)
+    # The vec2 f_rand overload, the cos key is quantized to 1/1000 steps
+    band_y = np.floor(np.cos((y // 5).astype(F32)) * F32(1000.0)).astype(
+        np.int64)
+    r = _noise_at(x // divisor, band_y, rand) * F32(10.0)
+    c = _noise_at(x, y + h, rand)
+    c = np.broadcast_to(c, r.shape)
+    mask = (r > F32(9.3)) & (c > F32(0.3)) & (c < F32(0.8))
+    static_color = (tex_color / F32(4.0) +
+                    _rgba(c, c, c, 1.0) * F32(3.0) / F32(4.0))
+    return np.where(mask[..., np.newaxis], static_color, tex_color)
+
+
+def scanlines(tex, frame, rand):
+    h, w = tex.shape[:2]
+    x, y = _coords(tex)
+    sub_x, sub_y = _sub_pixel(tex)
+    color_height = 7
+    color_width = 4
+    cell_height = color_height
+    cell_width = color_width * 3
+
+    x, y = np.broadcast_arrays(x, y)
+    coord_f_x = x.astype(F32) + F32(0.5)
+    offset_column = (x // cell_width) % 2 == 0
+    y = np.where(offset_column, y + cell_height // 2, y)
+    coord_f_y = y.astype(F32) + F32(0.5)
+
+    tmp_x = x - x % cell_width
+    tmp_y = y - y % color_height
+    tex_color = _sample(tex, sub_x + tmp_x.astype(F32) / F32(w),
+                        sub_y + tmp_y.astype(F32) / F32(h))
+
+    # Each cell is a red, green and blue column
+    channel = (x % cell_width) // color_width
+    mask = np.zeros(tex_color.shape, dtype=F32)
+    mask[..., 3] = 1.0
+    for i in range(3):
+        mask[..., i] = channel == i
+    tex_color = tex_color * mask
+
+    border = ((np.mod(coord_f_x, F32(color_width)) >
+               F32(color_width) - F32(0.7)) |
+              (np.mod(coord_f_y, F32(color_height)) >
+               F32(color_height) - F32(0.7)))
+    dark = tex_color * F32(0.5)
+    dark[..., 3] = 1.0
+    bright = np.clip(tex_color * F32(1.1), 0.0, 1.0)
+    return np.where(border[..., np.newaxis], dark, bright)
+
+
+CPU_FILTERS = {'first': first,
+               'second': second,
+               'third': third,
+               'rgb_shift': rgb_shift,
+               'repeat_end': repeat_end,
+               'static': static,
+               'static2': static2,
+               'scanlines': scanlines}
+
+# Filters whose shaders use the rand uniform
+RAND_FILTERS = ('first', 'static', 'static2')
+
+
+def store_pass(color):
+    """
+    What a gl pass does with a fragment color: blend it over the clear color
+    and store it in an 8 bit texture
+    """
+    color = np.clip(color, 0.0, 1.0)
+    alpha = color[..., 3:4]
+    color = color * alpha + CLEAR_COLOR * (F32(1.0) - alpha)
+    return np.floor(color * F32(255.0) + F32(0.5)) / F32(255.0)
+
+
+class CpuImageGlitch:
+    """
+    Same chain api as ImageGlitch (filter_img, update_filtered_image,
+    get_filter_img, screenshot) running on numpy instead of opengl
+    """
+    img_dimensions = (-1, -1)
+
+    filters = []
+
+    frame = 0
+
+    seed = DEF_SEED
+
+    source = None
+
+    result = None
+
+    def set_noise_pool(self, size, layers=NOISE_POOL_LAYERS,
+                       seed=NOISE_POOL_SEED):
+        """
+        Change the noise pool the static filters sample, like
+        ImageGlitch.set_noise_pool
+        """
+        global noise_texels, noise_pool
+        assert size > 0 and layers > 0, (
+            "Error: noise pool size and layers must be at least 1")
+        noise_pool = (size, layers, seed)
+        noise_texels = None
+        if self.source is not None:
+            self.update_filtered_image(update_frame_count=False)
+
+    def filter_img(self, img, filters):
+        assert all(name in CPU_FILTERS for name in filters), (
+            "Error, filter not found")
+        self.img_dimensions = img.size
+        self.filters = list(filters)
+        pixels = img.convert("RGBA").tobytes("raw", "RGBA", 0, -1)
+        self.source = np.frombuffer(pixels, dtype=np.uint8).reshape(
+            img.size[1], img.size[0], 4)
+        self.update_filtered_image(update_frame_count=False)
+
+    def update_filtered_image(self, update_frame_count=True):
+        """
+        Run the chain, each pass stored the way a framebuffer would
+        """
+        tex = self.source.astype(F32) / F32(255.0)
+        for index, name in enumerate(self.filters):
+            rand = (frame_rand(self.seed, self.frame, index)
+                    if name in RAND_FILTERS else 0.0)
+            tex = store_pass(CPU_FILTERS[name](tex, self.frame, rand))
+        self.result = np.floor(tex * F32(255.0) + F32(0.5)).astype(np.uint8)
+        if update_frame_count:
+            self.frame += 1
+
+    def get_filter_pixels(self):
+        """
+        Filtered image as bottom up RGBA bytes like glReadPixels
+        """
+        return self.result.tobytes()
+
+    def get_filter_img(self):
+        return pixels_to_image(self.get_filter_pixels(), self.img_dimensions)
+
+    def screenshot(self, filename):
+        save_png(filename, self.get_filter_pixels(), self.img_dimensions)
+
+
+def _time_ms(func, repeats):
+    func()  # warm up
+    start = time.time()
+    for i in range(repeats):
+        func()
+    return (time.time() - start) * 1000.0 / repeats
+
+
+def benchmark(megapixels=(1, 4, 16), repeats=3, use_gl=True):
+    """
+    Print ms per frame for each filter on the cpu and, if a headless gl
+    context can be created, on gl
+    """
+    gl_glitch = None
+    if use_gl:
+        try:
+            import headless
+            headless.setup_platform()
+            from OpenGL import GL as gl
+            from image_glitch import ImageGlitch
+            gl_glitch = ImageGlitch(headless=True)
+            # Time the whole chain every frame, not cache hits
+            gl_glitch.stage_cache.set_budget(0)
+            gl_glitch.frame_ring.set_budget(0)
+            gl_glitch.target_pool.set_budget(0)
+        except Exception as e:
+            print("No gl context, only benchmarking cpu: %s" % (e))
+
+    print("%-12s %6s %12s %12s" % ("filter", "MP", "cpu ms", "gl ms"))
+    for mp in megapixels:
+        side = int((mp * 1000000) ** 0.5)
+        noise = np.random.randint(0, 256, (side, side, 4), dtype=np.uint8)
+        img = Image.fromarray(noise, "RGBA")
+        cpu_glitch = CpuImageGlitch()
+        for name in sorted(CPU_FILTERS):
+            cpu_glitch.filter_img(img, [name])
+            cpu_ms = _time_ms(cpu_glitch.update_filtered_image, repeats)
+            gl_ms = "-"
+            if gl_glitch:
+                gl_glitch.filter_img(img, [name])
+
+                def render_gl():
+                    gl_glitch.update_filtered_image()
+                    gl.glFinish()
+                gl_ms = "%.2f" % (_time_ms(render_gl, repeats))
+            print("%-12s %6s %12.2f %12s" % (name, mp, cpu_ms, gl_ms))
+        img.close()
+    if gl_glitch:
+        gl_glitch.cleanup()
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        benchmark([float(mp) for mp in sys.argv[1:]])
+    else:
+        benchmark()
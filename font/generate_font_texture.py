@@ -1,12 +1,28 @@
 #!/bin/python
+"""
+Writes font_tex.png, the 16 px fallback atlas, and font.atlas, the raw
+atlas the console loads with every size in font_atlas.DEF_SIZES. Extra
+sizes can be given as arguments. The console also builds font.atlas itself
+when it is missing or lacks a size.
+"""
+import os
+import sys
 from PIL import Image, ImageDraw, ImageFont
 
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'shader_filters'))
+import font_atlas
+
 CHARS = [chr(i) for i in range(256)]
 
-fnt = ImageFont.truetype('RobotoMono-Bold.ttf', 16)
+fnt = ImageFont.truetype(os.path.join(HERE, 'RobotoMono-Bold.ttf'), 16)
 img = Image.new("RGBA", (10*16, 20*16), color=(0, 0, 0, 0))
 d = ImageDraw.Draw(img)
 for i in range(len(CHARS)):
     d.text((i % 16 * 10, int(i/16) * 20),
            CHARS[i], font=fnt, fill=(255, 255, 255, 255))
-img.save('font_tex.png', compress_level=0)
+img.save(os.path.join(HERE, 'font_tex.png'), compress_level=0)
+
+sizes = set(font_atlas.DEF_SIZES) | set(int(a) for a in sys.argv[1:])
+font_atlas.build_atlas(os.path.join(HERE, 'font.atlas'),
+                       os.path.join(HERE, 'RobotoMono-Bold.ttf'), sizes)
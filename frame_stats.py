@@ -0,0 +1,117 @@
+import ctypes
+import time
+from collections import deque
+from OpenGL import GL as gl
+
+# Queries still waiting on the gpu past this are skipped, so a driver that
+# never answers can't grow the queue
+MAX_PENDING_QUERIES = 256
+
+# Stages not timed for this long are left out of the summary
+STALE_SECONDS = 5.0
+
+
+class FrameStats:
+    """
+    Rolling gpu and cpu times per stage plus render and present rates. The
+    gpu times come from GL_TIME_ELAPSED queries that are only read once the
+    driver reports them available, a frame or two later, so collecting them
+    never waits on the gpu. Stages can't be nested, gl only allows one
+    GL_TIME_ELAPSED query at a time.
+    """
+    history = 60
+
+    # Off until turned on, headless runs never read the timer queries
+    enabled = False
+
+    def __init__(self):
+        self.free_queries = []
+        self.pending = deque()
+        self.current = None
+        self.gpu_ms = {}
+        self.cpu_ms = {}
+        self.last_seen = {}
+        self.ticks = {}
+
+    def begin(self, name):
+        if not self.enabled or len(self.pending) >= MAX_PENDING_QUERIES:
+            return
+        if self.free_queries:
+            query = self.free_queries.pop()
+        else:
+            query = gl.glGenQueries(1)
+        gl.glBeginQuery(gl.GL_TIME_ELAPSED, query)
+        self.current = (name, query, time.time())
+
+    def end(self):
+        if not self.current:
+            return
+        name, query, start = self.current
+        gl.glEndQuery(gl.GL_TIME_ELAPSED)
+        self._add(self.cpu_ms, name, (time.time() - start) * 1000.0)
+        self.pending.append((name, query))
+        self.current = None
+
+    def collect(self):
+        """
+        Read back the queries the gpu has finished, oldest first
+        """
+        available = gl.GLint(0)
+        elapsed = gl.GLuint64(0)
+        while self.pending:
+            name, query = self.pending[0]
+            gl.glGetQueryObjectiv(query, gl.GL_QUERY_RESULT_AVAILABLE,
+                                  ctypes.byref(available))
+            if not available.value:
+                break
+            gl.glGetQueryObjectui64v(query, gl.GL_QUERY_RESULT,
+                                     ctypes.byref(elapsed))
+            self._add(self.gpu_ms, name, elapsed.value / 1000000.0)
+            self.free_queries.append(self.pending.popleft()[1])
+
+    def tick(self, name):
+        """
+        Count a rendered or presented frame for the rate of name
+        """
+        if name not in self.ticks:
+            self.ticks[name] = deque(maxlen=self.history)
+        self.ticks[name].append(time.time())
+
+    def rate(self, name):
+        ticks = self.ticks.get(name)
+        if not ticks or len(ticks) < 2 or time.time() - ticks[-1] > 1.0:
+            return 0.0
+        return (len(ticks) - 1) / (ticks[-1] - ticks[0])
+
+    def _add(self, times, name, ms):
+        if name not in times:
+            times[name] = deque(maxlen=self.history)
+        times[name].append(ms)
+        self.last_seen[name] = time.time()
+
+    def summary(self):
+        """
+        Returns lines with the rates and average gpu and cpu ms per stage
+        """
+        lines = ["render %.1f fps, present %.1f fps" % (
+            self.rate('render'), self.rate('present'))]
+        now = time.time()
+        for name in sorted(self.cpu_ms):
+            if now - self.last_seen[name] > STALE_SECONDS:
+                continue
+            cpu = self.cpu_ms[name]
+            gpu = self.gpu_ms.get(name)
+            gpu_str = "%.2f" % (sum(gpu) / len(gpu)) if gpu else "-"
+            lines.append("%-24s gpu %6s ms cpu %6.2f ms" % (
+                name[:24], gpu_str, sum(cpu) / len(cpu)))
+        return lines
+
+    def cleanup(self):
+        queries = self.free_queries + [q for name, q in self.pending]
+        if self.current:
+            queries.append(self.current[1])
+        for query in queries:
+            gl.glDeleteQueries(1, int(query))
+        self.free_queries = []
+        self.pending = deque()
+        self.current = None
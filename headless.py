@@ -0,0 +1,152 @@
+import ctypes
+import os
+
+# PyOpenGL picks the library it loads gl functions from when OpenGL.GL is
+# first imported, so PYOPENGL_PLATFORM has to be set to one of these before
+# importing image_glitch for a headless context to work.
+HEADLESS_PLATFORMS = ('egl', 'osmesa')
+
+DEF_HEADLESS_PLATFORM = 'egl'
+
+
+def setup_platform(platform=DEF_HEADLESS_PLATFORM):
+    """
+    Select the PyOpenGL platform used for headless rendering. Has to be
+    called before OpenGL is imported
+    """
+    assert platform in HEADLESS_PLATFORMS, (
+        "Error: unknown headless platform %s" % (platform))
+    os.environ.setdefault('PYOPENGL_PLATFORM', platform)
+
+
+class HeadlessContext:
+    """
+    Creates an opengl 3.3 core context without a window, using either EGL
+    with a pbuffer surface or OSMesa (llvmpipe). Everything ImageGlitch
+    renders goes into its own framebuffers so the default framebuffer is
+    only a 1x1 placeholder.
+    """
+    platform = None
+
+    display = None
+
+    surface = None
+
+    context = None
+
+    osmesa_buffer = None
+
+    def __init__(self, platform=None):
+        if platform is None:
+            platform = os.environ.get('PYOPENGL_PLATFORM',
+                                      DEF_HEADLESS_PLATFORM)
+        assert platform in HEADLESS_PLATFORMS, (
+            "Error: headless rendering needs PYOPENGL_PLATFORM set to one "
+            "of %s before OpenGL is imported" % (", ".join(HEADLESS_PLATFORMS)))
+        self.platform = platform
+        if platform == 'egl':
+            self._init_egl()
+        else:
+            self._init_osmesa()
+
+    def _init_egl(self):
+        from OpenGL import EGL
+
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major = EGL.EGLint()
+        minor = EGL.EGLint()
+        assert EGL.eglInitialize(self.display, ctypes.pointer(major),
+                                 ctypes.pointer(minor)), (
+            "Error: Could not initialize EGL display")
+
+        config_attribs = [
+            EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+            EGL.EGL_RED_SIZE, 8,
+            EGL.EGL_GREEN_SIZE, 8,
+            EGL.EGL_BLUE_SIZE, 8,
+            EGL.EGL_ALPHA_SIZE, 8,
+            EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+            EGL.EGL_NONE,
+        ]
+        config_attribs = (EGL.EGLint * len(config_attribs))(*config_attribs)
+        config = EGL.EGLConfig()
+        num_configs = EGL.EGLint()
+        assert EGL.eglChooseConfig(self.display, config_attribs,
+                                   ctypes.pointer(config), 1,
+                                   ctypes.pointer(num_configs)), (
+            "Error: Could not choose EGL config")
+        assert num_configs.value > 0, "Error: No matching EGL config"
+
+        pbuffer_attribs = [
+            EGL.EGL_WIDTH, 1,
+            EGL.EGL_HEIGHT, 1,
+            EGL.EGL_NONE,
+        ]
+        pbuffer_attribs = (EGL.EGLint * len(pbuffer_attribs))(
+            *pbuffer_attribs)
+        self.surface = EGL.eglCreatePbufferSurface(
+            self.display, config, pbuffer_attribs)
+        assert self.surface != EGL.EGL_NO_SURFACE, (
+            "Error: Could not create EGL pbuffer surface")
+
+        assert EGL.eglBindAPI(EGL.EGL_OPENGL_API), (
+            "Error: Could not bind EGL opengl api")
+        context_attribs = [
+            EGL.EGL_CONTEXT_MAJOR_VERSION, 3,
+            EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+            EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+            EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+            EGL.EGL_NONE,
+        ]
+        context_attribs = (EGL.EGLint * len(context_attribs))(
+            *context_attribs)
+        self.context = EGL.eglCreateContext(
+            self.display, config, EGL.EGL_NO_CONTEXT, context_attribs)
+        assert self.context != EGL.EGL_NO_CONTEXT, (
+            "Error: Could not create EGL context")
+        assert EGL.eglMakeCurrent(self.display, self.surface, self.surface,
+                                  self.context), (
+            "Error: Could not make EGL context current")
+
+    def _init_osmesa(self):
+        from OpenGL import GL as gl
+        from OpenGL import arrays
+        from OpenGL import osmesa
+
+        context_attribs = [
+            osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+            osmesa.OSMESA_DEPTH_BITS, 24,
+            osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+            osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 3,
+            osmesa.OSMESA_CONTEXT_MINOR_VERSION, 3,
+            0,
+        ]
+        context_attribs = arrays.GLintArray.asArray(context_attribs)
+        self.context = osmesa.OSMesaCreateContextAttribs(context_attribs,
+                                                         None)
+        assert self.context, "Error: Could not create OSMesa context"
+        self.osmesa_buffer = arrays.GLubyteArray.zeros((1, 1, 4))
+        assert osmesa.OSMesaMakeCurrent(self.context, self.osmesa_buffer,
+                                        gl.GL_UNSIGNED_BYTE, 1, 1), (
+            "Error: Could not make OSMesa context current")
+
+    def destroy(self):
+        """
+        Release the context and any surfaces created for it
+        """
+        if self.platform == 'egl' and self.display is not None:
+            from OpenGL import EGL
+            EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE,
+                               EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+            if self.context is not None:
+                EGL.eglDestroyContext(self.display, self.context)
+            if self.surface is not None:
+                EGL.eglDestroySurface(self.display, self.surface)
+            EGL.eglTerminate(self.display)
+            self.display = None
+        elif self.platform == 'osmesa' and self.context is not None:
+            from OpenGL import osmesa
+            osmesa.OSMesaDestroyContext(self.context)
+            self.osmesa_buffer = None
+        self.context = None
+        self.surface = None
@@ -1,13 +1,42 @@
 import ctypes
+import logging
+from collections import deque, OrderedDict
+from itertools import islice
 from OpenGL import GL as gl
 from PIL import Image
 import sdl2
 from shader_filters import *
+from shader_filters import program_cache, noise_pool, font_atlas
+from headless import HeadlessContext
+from seeds import DEF_SEED, NOISE_POOL_LAYERS, NOISE_POOL_SEED
+from frame_stats import FrameStats
+from tracing import Tracer, TRACE_ENV, DEF_TRACE_FILE
+from recording import (PngSink, EncoderSink, FrameWriter, JobCounter,
+                       pixels_to_image, save_png)
+import math
+import os
 import random
+import time
 
 DEF_WINDOW_WIDTH = 1024
 DEF_WINDOW_HEIGHT = 768
 
+WINDOW_TITLE = "DPT GLITCH GUY"
+
+# Program build times go here, headless runs have no console to show them
+log = logging.getLogger(__name__)
+
+
+def program_build_message(name, start):
+    """
+    How long building the program called name took since start, warm starts
+    load it from the program binary cache
+    """
+    stats = program_cache.stats
+    return ("Built %s in %.1f ms (%d cached, %d compiled, %d rejected so "
+            "far)" % (name, (time.time() - start) * 1000.0, stats["hits"],
+                      stats["misses"], stats["rejected"]))
+
 
 class View:
     """
@@ -24,22 +53,29 @@ class View:
 
 class Console:
     """
-    Hold logic for dealing with console input and output
+    Hold logic for dealing with console input and output. History is kept
+    in bounded deques, newest first, and only the lines that fit in the
+    window are ever sent to the console filter.
     """
     console_prompt = ">"
 
-    input_buffer = []
-
-    output_buffer = []
-
     current_input = ""
 
     max_buffer_len = 100
 
+    # Lines the window can show, updated on render
+    visible_lines = 64
+
     line_number = 0
 
     console_filter = None
 
+    font_size = font_atlas.DEF_FONT_SIZE
+
+    def __init__(self):
+        self.input_buffer = deque(maxlen=self.max_buffer_len)
+        self.output_buffer = deque(maxlen=self.max_buffer_len)
+
     def cleanup(self):
         if self.console_filter:
             self.console_filter.cleanup_shader()
@@ -48,17 +84,34 @@ class Console:
     def _create_shader(self):
         if not self.console_filter:
             offset = (0, 0)
-            self.console_filter = ConsoleFilter()
+            start = time.time()
+            self.console_filter = ConsoleFilter(self.font_size)
+            log.info(program_build_message("console", start))
             self.console_filter.add_str(self.console_prompt, offset)
 
+    def set_font_size(self, size):
+        """
+        Recreate the console filter with another font size and write the
+        history back, returns the size in use, the png fallback only has one
+        """
+        self.cleanup()
+        self.font_size = size
+        self.console_filter = ConsoleFilter(size)
+        history = list(reversed(self.get_output(self.max_buffer_len)))
+        self.console_filter.add_str(
+            "\n".join(history + [self.get_input()]), (0, 0))
+        return self.console_filter.font_size
+
     def render(self, window_dimensions):
         self._create_shader()
+        line_height = self.console_filter.img_dimensions[1] / 16
+        self.visible_lines = window_dimensions[1] // line_height + 1
         offset = (0, 0)
         self.console_filter.render(offset, window_dimensions)
 
     def clear(self):
         self.line_number = 0
-        self.output_buffer = []
+        self.output_buffer.clear()
         self.console_filter.clear()
         offset = (0, 0)
         self.console_filter.add_str(self.console_prompt, offset)
@@ -68,23 +121,24 @@ class Console:
 
     def add_input(self, text):
         self._create_shader()
-        self.input_buffer = [text] + \
-            self.input_buffer[:self.max_buffer_len - 1]
+        self.input_buffer.appendleft(text)
         self.add_output(self.get_formatted_input(text), update_filter=False)
 
     def add_output(self, text, update_filter=True, update_line_number=True):
-        for t in text.split("\n"):
-            if update_line_number:
-                self.line_number += 1
-            if update_filter:
-                self.console_filter.backspace(len(self.get_input()))
-                self.console_filter.add_str(
-                    "%s\n%s" % (t, self.get_input()), (0, 0))
-            self.output_buffer = [t] + \
-                self.output_buffer[:self.max_buffer_len - 1]
+        lines = text.split("\n")
+        if update_line_number:
+            self.line_number += len(lines)
+        self.output_buffer.extendleft(lines)
+        if update_filter:
+            self._create_shader()
+            # Lines that would scroll out of the window anyway are skipped
+            visible = lines[-self.visible_lines:]
+            self.console_filter.backspace(len(self.get_input()))
+            self.console_filter.add_str(
+                "%s\n%s" % ("\n".join(visible), self.get_input()), (0, 0))
 
     def get_output(self, num_lines):
-        return self.output_buffer[:num_lines]
+        return list(islice(self.output_buffer, num_lines))
 
     def get_input(self):
         return self.get_formatted_input(self.current_input)
@@ -128,6 +182,274 @@ class Console:
         return inputted_commands
 
 
+class StageCache:
+    """
+    Keeps the output textures of deterministic chain prefixes, keyed by the
+    filter names of the prefix, so frames and chain edits only render from
+    the first stage that can change. Least recently used textures are
+    deleted to stay within budget bytes.
+    """
+    budget = 256 * 1024 * 1024
+
+    # The most recent entry is the input of the pass being rendered
+    keep_recent = 1
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.used = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """
+        Returns (texture, framebuffer) for key and marks it recently used
+        """
+        entry = self.entries.pop(key)
+        self.entries[key] = entry
+        return entry[:2]
+
+    def create(self, key, dimensions):
+        """
+        Allocate a render target for key, returns (texture, framebuffer) or
+        None if it doesn't fit in the budget
+        """
+        size = self.entry_size(dimensions)
+        reuse = None
+        while (len(self.entries) > self.keep_recent and
+               self.used + size > self.budget):
+            entry = self.entries.popitem(last=False)[1]
+            if reuse is None and entry[2] == dimensions:
+                # Same size, render into it instead of allocating again
+                reuse = entry
+                self.used -= size
+            else:
+                self._delete(entry)
+        if self.used + size > self.budget:
+            if reuse:
+                self._delete(reuse, False)
+            return None
+        if reuse:
+            self.entries[key] = reuse
+            self.used += size
+            return reuse[:2]
+
+        texture = gl.glGenTextures(1)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, texture)
+        gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER,
+                           gl.GL_NEAREST)
+        gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER,
+                           gl.GL_NEAREST)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA8, dimensions[0],
+                        dimensions[1], 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE,
+                        None)
+        fb = gl.glGenFramebuffers(1)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, fb)
+        gl.glFramebufferTexture2D(gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0,
+                                  gl.GL_TEXTURE_2D, texture, 0)
+        assert (gl.GL_FRAMEBUFFER_COMPLETE ==
+                gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER)), (
+            "Stage cache framebuffer isn't completely initialized")
+        self.entries[key] = (texture, fb, dimensions)
+        self.used += size
+        return texture, fb
+
+    def entry_size(self, dimensions):
+        """
+        How much of the budget a texture of dimensions takes
+        """
+        return dimensions[0] * dimensions[1] * 4
+
+    def set_budget(self, budget):
+        self.budget = budget
+        while self.entries and self.used > self.budget:
+            self._delete(self.entries.popitem(last=False)[1])
+
+    def _delete(self, entry, counted=True):
+        texture, fb, dimensions = entry
+        gl.glDeleteFramebuffers(1, int(fb))
+        gl.glDeleteTextures(int(texture))
+        if counted:
+            self.used -= self.entry_size(dimensions)
+
+    def clear(self):
+        for entry in self.entries.values():
+            self._delete(entry)
+        self.entries = OrderedDict()
+
+
+class FrameRing(StageCache):
+    """
+    Keeps the last rendered output textures keyed by (frame, seed, filter
+    names) so looping, stepping back and jumping to a frame that was
+    already rendered only has to present it. Least recently used frames are
+    deleted to stay within budget bytes.
+    """
+    budget = 256 * 1024 * 1024
+
+    keep_recent = 0
+
+    def store(self, key, source_fb, dimensions):
+        """
+        Copy what is in source_fb into the ring as key
+        """
+        if key in self:
+            entry = self.get(key)
+        else:
+            entry = self.create(key, dimensions)
+        if not entry:
+            return
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, source_fb)
+        gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, entry[1])
+        gl.glBlitFramebuffer(0, 0, dimensions[0], dimensions[1],
+                             0, 0, dimensions[0], dimensions[1],
+                             gl.GL_COLOR_BUFFER_BIT, gl.GL_NEAREST)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, source_fb)
+
+
+class TargetPool:
+    """
+    The image texture, render target textures and framebuffers of images
+    that were filtered before, keyed by dimensions. Loading another image
+    of a size in the pool takes them back instead of allocating new ones.
+    Least recently released sizes are deleted to stay within budget bytes.
+    """
+    budget = 256 * 1024 * 1024
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.used = 0
+
+    def take(self, dimensions):
+        """
+        Returns (texture_ids, fb_ids) for dimensions, None if the pool has
+        none that size
+        """
+        entry = self.entries.pop(dimensions, None)
+        if entry:
+            self.used -= self.entry_size(dimensions, entry)
+        return entry
+
+    def put(self, dimensions, texture_ids, fb_ids):
+        entry = (dict(texture_ids), dict(fb_ids))
+        if dimensions in self.entries:
+            self._delete(self.take(dimensions))
+        if self.entry_size(dimensions, entry) > self.budget:
+            # Would push everything else out and still not fit
+            self._delete(entry)
+            return
+        self.entries[dimensions] = entry
+        self.used += self.entry_size(dimensions, entry)
+        self.set_budget(self.budget)
+
+    def entry_size(self, dimensions, entry):
+        return dimensions[0] * dimensions[1] * 4 * len(entry[0])
+
+    def set_budget(self, budget):
+        self.budget = budget
+        while self.entries and self.used > self.budget:
+            dimensions, entry = self.entries.popitem(last=False)
+            self.used -= self.entry_size(dimensions, entry)
+            self._delete(entry)
+
+    def _delete(self, entry):
+        texture_ids, fb_ids = entry
+        for v in fb_ids.itervalues():
+            gl.glDeleteFramebuffers(1, int(v))
+        for v in texture_ids.itervalues():
+            gl.glDeleteTextures(int(v))
+
+    def clear(self):
+        for entry in self.entries.values():
+            self._delete(entry)
+        self.entries = OrderedDict()
+        self.used = 0
+
+
+class FrameScheduler:
+    """
+    Fixed timestep for play mode, frame n is due at start + n * interval so
+    the rate doesn't drift with how long each frame takes. When a frame is
+    late by a whole interval or more the policy decides what happens:
+    drop skips the frames whose time has passed and renders the current one,
+    catchup renders the missed frames back to back (at most max_catchup
+    behind, older ones are dropped), slow renders the next frame and moves
+    the schedule so the animation slows down instead of skipping.
+    """
+    POLICIES = ('drop', 'catchup', 'slow')
+
+    policy = 'drop'
+
+    max_catchup = 5
+
+    running = False
+
+    def __init__(self, fps):
+        self.set_fps(fps)
+        self.start(0)
+        self.running = False
+
+    def set_fps(self, fps):
+        self.interval = 1000.0 / fps
+
+    def start(self, now):
+        self.started = now
+        self.stopped = now
+        self.next_due = now
+        self.rendered = 0
+        self.missed = 0
+        self.dropped = 0
+        self.running = True
+
+    def stop(self, now):
+        """
+        Stop the schedule, the report keeps the rate it had at now
+        """
+        if self.running:
+            self.stopped = now
+        self.running = False
+
+    def time_until_due(self, now):
+        return max(0.0, self.next_due - now)
+
+    def tick(self, now, can_skip=True):
+        """
+        Returns how many frames the animation moves forward by if a frame is
+        due at now, otherwise 0. Only the last of them is rendered. Without
+        can_skip (recording) every frame is rendered and drop acts like slow.
+        """
+        if now < self.next_due:
+            return 0
+        policy = self.policy
+        if policy == 'drop' and not can_skip:
+            policy = 'slow'
+        behind = int((now - self.next_due) // self.interval)
+        skipped = 0
+        if behind:
+            if policy == 'drop':
+                skipped = behind
+            elif policy == 'catchup' and can_skip:
+                skipped = max(0, behind - self.max_catchup)
+            # Deadlines that pass without their own frame on screen
+            self.missed += skipped if policy == 'drop' else skipped + 1
+            self.dropped += skipped
+        if policy == 'slow' and behind:
+            self.next_due = now + self.interval
+        else:
+            self.next_due += (skipped + 1) * self.interval
+        self.rendered += 1
+        return skipped + 1
+
+    def report(self, now):
+        if not self.running:
+            now = self.stopped
+        seconds = max(now - self.started, 1) / 1000.0
+        return ("%.1f fps target, %.1f achieved, %s rendered, %s missed "
+                "deadlines, %s dropped (%s)" % (
+                    1000.0 / self.interval, self.rendered / seconds,
+                    self.rendered, self.missed, self.dropped, self.policy))
+
+
 class ImageGlitch:
     """
     Image glitching class, uses opengl shaders to filters images. SDL2 window
@@ -155,14 +477,64 @@ class ImageGlitch:
 
     img_dimensions = (-1, -1)
 
+    # Pixel buffer objects used to read frames back without stalling, a
+    # frame is only mapped once the ring wraps around to its buffer
+    readback_depth = 3
+
+    readback_pbos = []
+
+    readback_pending = deque()
+
+    readback_index = 0
+
     view = View()
 
     window = None
 
+    headless_context = None
+
     window_dimensions = (DEF_WINDOW_WIDTH, DEF_WINDOW_HEIGHT)
 
+    # Compiled filters by name, filled in on first use by get_filter
     all_filters = {}
 
+    filter_last_used = {}
+
+    # Seconds a compiled filter can sit outside the chain before its program
+    # is deleted, None keeps them forever
+    filter_idle_timeout = 60.0
+
+    # Consecutive fusable filters are rendered as one pass, the fused
+    # programs are cached by the names of the filters they were built from
+    fuse_filters = True
+
+    fused_filters = {}
+
+    fused_last_used = {}
+
+    stage_cache = None
+
+    # Textures and framebuffers of earlier images, reused by the next load
+    # of the same size
+    target_pool = None
+
+    # Rendered frames kept on the gpu for loop, back and jump
+    frame_ring = None
+
+    # Gpu and cpu time per stage, shown by the stats command
+    frame_stats = None
+
+    # Show the stats in the window title, refreshed every interval seconds
+    stats_overlay = False
+
+    stats_overlay_interval = 0.5
+
+    stats_overlay_last = 0
+
+    # Chrome trace of the run loop phases and commands, off unless started
+    # with the trace command or IMAGE_GLITCH_TRACE
+    tracer = None
+
     filters = []
 
     final_filter = None
@@ -173,6 +545,15 @@ class ImageGlitch:
 
     frame = 0
 
+    # rand for each filter is derived from (seed, frame, index in chain)
+    seed = DEF_SEED
+
+    # Frame number of what is on screen, frame is the next one to render
+    shown_frame = 0
+
+    # (first, last) frames played over and over from the frame ring
+    loop_range = None
+
     playing = False
 
     recording = False
@@ -181,30 +562,180 @@ class ImageGlitch:
 
     recording_frame_num = -1
 
+    recording_sink = None
+
+    # Frames and screenshots are encoded and saved on background threads,
+    # recording_writer is the one the current (or finishing) recording uses
+    writer_threads = 2
+
+    writer_queue_len = 8
+
+    frame_writer = None
+
+    recording_writer = None
+
+    recording_saved = 0
+
+    recording_total = 0
+
+    # The recording's own jobs, screenshots can share its writer
+    recording_jobs = None
+
     fps = 10
 
-    last_update = sdl2.SDL_GetTicks()
+    # ms to sleep in SDL_WaitEventTimeout when nothing is playing, shorter
+    # while recorded frames are being written or the stats overlay is on
+    idle_timeout = 1000
 
-    def __init__(self):
-        self.init_sdl()
-        self.all_filters = {k: v() for k, v in ALL_FILTERS.iteritems()}
+    busy_timeout = 100
+
+    frame_scheduler = None
+
+    def __init__(self, headless=False):
+        if headless:
+            self.init_headless()
+        else:
+            self.init_sdl()
+        self.all_filters = {}
+        self.filter_last_used = {}
+        self.fused_filters = {}
+        self.fused_last_used = {}
+        self.stage_cache = StageCache()
+        self.target_pool = TargetPool()
+        self.frame_ring = FrameRing()
+        self.frame_stats = FrameStats()
+        # Only the window has a console to show them in
+        self.frame_stats.enabled = not headless
+        self.frame_scheduler = FrameScheduler(self.fps)
+        self.tracer = Tracer()
+        if os.environ.get(TRACE_ENV):
+            self.tracer.start(os.environ[TRACE_ENV])
+
+    def get_filter(self, name):
+        """
+        Returns the filter called name, compiling its program the first time
+        it is referenced
+        """
+        assert name in ALL_FILTERS, "Error, filter not found"
+        if name not in self.all_filters:
+            start = time.time()
+            self.all_filters[name] = ALL_FILTERS[name]()
+            self.report_program_cache("filter %s" % (name), start)
+        self.filter_last_used[name] = time.time()
+        return self.all_filters[name]
+
+    def get_filter_name(self, shader_filter):
+        for name, val in self.all_filters.iteritems():
+            if val is shader_filter:
+                return name
+        return None
+
+    def evict_idle_filters(self):
+        """
+        Delete programs of filters that have not been in the chain for
+        filter_idle_timeout seconds
+        """
+        if self.filter_idle_timeout is None:
+            return
+        now = time.time()
+        for name, val in list(self.all_filters.items()):
+            if val in self.filters:
+                self.filter_last_used[name] = now
+            elif now - self.filter_last_used[name] > self.filter_idle_timeout:
+                val.cleanup_shader()
+                del self.all_filters[name]
+                del self.filter_last_used[name]
+        # Fused runs of the chain on screen stay, even if nothing has
+        # rendered it for a while
+        chain = self.get_chain_key()
+        for key, val in list(self.fused_filters.items()):
+            if any(chain[i:i + len(key)] == key for i in range(len(chain))):
+                self.fused_last_used[key] = now
+            elif now - self.fused_last_used[key] > self.filter_idle_timeout:
+                val.cleanup_shader()
+                del self.fused_filters[key]
+                del self.fused_last_used[key]
+
+    def get_chain_key(self):
+        return tuple(self.get_filter_name(f) for f in self.filters)
+
+    def get_render_passes(self):
+        """
+        Returns (filter names, filter) for each pass that has to be rendered
+        for the chain, runs of fusable filters are replaced by a single
+        fused filter
+        """
+        if not self.fuse_filters:
+            return [((self.get_filter_name(f),), f) for f in self.filters]
+        runs = []
+        cacheable = self.stage_cache.budget > 0
+        for run in split_fusable_runs(self.filters):
+            # Keep the deterministic start of the chain in its own pass so
+            # its output can go in the stage cache
+            if cacheable and not all(f.deterministic for f in run):
+                cacheable = False
+                split = [f.deterministic for f in run].index(False)
+                if split:
+                    runs.append(run[:split])
+                    run = run[split:]
+            runs.append(run)
+        passes = []
+        for run in runs:
+            key = tuple(self.get_filter_name(f) for f in run)
+            if len(run) == 1:
+                passes.append((key, run[0]))
+                continue
+            if key not in self.fused_filters:
+                start = time.time()
+                self.fused_filters[key] = FusedFilter(run)
+                self.report_program_cache("fused %s" % ("+".join(key)),
+                                          start)
+            self.fused_last_used[key] = time.time()
+            passes.append((key, self.fused_filters[key]))
+        return passes
+
+    def cleanup_fused_filters(self):
+        for val in self.fused_filters.itervalues():
+            val.cleanup_shader()
+        self.fused_filters = {}
+        self.fused_last_used = {}
+
+    def report_program_cache(self, name, start):
+        """
+        Log how long building a program took, the window also shows it in
+        the console
+        """
+        message = program_build_message(name, start)
+        log.info(message)
+        if self.window:
+            self.console.add_output(message)
 
     def filter_img(self, img, filters):
         """
         this should destroy any existing resources if they exist, then
         init program for new image
         """
-        self.cleanup_img_fb()
-        self.cleanup_image_texture()
+        self.write_readbacks(self.flush_readback())
+        self.cleanup_readback_ring()
+        self.stage_cache.clear()
+        self.frame_ring.clear()
+        self.release_image_targets()
+
+        if (self.recording and self.recording_sink.fixed_size and
+                img.size != self.img_dimensions):
+            self.console.add_output("Image size changed, stopped recording")
+            self.stop_recording()
 
         self.img_dimensions = img.size
 
-        assert all(name in self.all_filters for name in filters), (
+        assert all(name in ALL_FILTERS for name in filters), (
             "Error, filter not found")
 
-        self.filters = [self.all_filters[n] for n in filters]
+        self.filters = [self.get_filter(n) for n in filters]
         if not self.final_filter:
+            start = time.time()
             self.final_filter = OrthoFilter()
+            self.report_program_cache("ortho", start)
 
         self.init_image_texture(img)
         self.init_img_fb()
@@ -224,7 +755,7 @@ class ImageGlitch:
         sdl2.SDL_GL_SetAttribute(sdl2.SDL_GL_DEPTH_SIZE, 24)
         sdl2.SDL_GL_SetSwapInterval(0)  # 0 = no vsync
         self.window = sdl2.SDL_CreateWindow(
-            "DPT GLITCH GUY",
+            WINDOW_TITLE,
             sdl2.SDL_WINDOWPOS_UNDEFINED,
             sdl2.SDL_WINDOWPOS_UNDEFINED,
             DEF_WINDOW_WIDTH,
@@ -233,6 +764,21 @@ class ImageGlitch:
         assert self.window, "Error: Could not create window"
         sdl2.SDL_SetWindowResizable(self.window, True)
         glcontext = sdl2.SDL_GL_CreateContext(self.window)
+        self.init_gl_state()
+
+    def init_headless(self):
+        """
+        Create an opengl context without a window, used when there is no
+        display. Only filtering, screenshots and reading back the filtered
+        image are available, there is nothing to present to.
+        """
+        self.headless_context = HeadlessContext()
+        self.init_gl_state()
+
+    def init_gl_state(self):
+        """
+        Set up the gl state shared by windowed and headless contexts
+        """
         gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
         gl.glEnable(gl.GL_CULL_FACE)
         gl.glEnable(gl.GL_BLEND)
@@ -250,9 +796,12 @@ class ImageGlitch:
     def init_img_fb(self):
         """
         Create 2 framebuffers to use for swapping image to texture for post
-        processing shaders
+        processing shaders, framebuffers taken from the target pool are
+        already attached
         """
         for name in self.fb_ids:
+            if self.fb_ids[name] != -1:
+                continue
             self.fb_ids[name] = gl.glGenFramebuffers(1)
             gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.fb_ids[name])
             gl.glFramebufferTexture2D(
@@ -278,100 +827,412 @@ class ImageGlitch:
                 gl.glDeleteTextures(v)
                 self.texture_ids[k] = -1
 
+    def release_image_targets(self):
+        """
+        Hand the textures and framebuffers of the current image to the
+        target pool for the next image of the same size
+        """
+        if all(v != -1 for v in self.texture_ids.itervalues()) and all(
+                v != -1 for v in self.fb_ids.itervalues()):
+            self.target_pool.put(self.img_dimensions, self.texture_ids,
+                                 self.fb_ids)
+        else:
+            self.cleanup_img_fb()
+            self.cleanup_image_texture()
+        self.texture_ids = dict((k, -1) for k in self.texture_ids)
+        self.fb_ids = dict((k, -1) for k in self.fb_ids)
+
     def init_image_texture(self, img):
         """
-        allocate textures that are the size of the imported image. One will be
-        attached to a framebuffer.
+        Take textures that are the size of the imported image from the
+        target pool or allocate them, then upload the image. Only the img
+        texture gets the pixels, the others are render targets and are
+        attached to framebuffers by init_img_fb.
         """
+        entry = self.target_pool.take(img.size)
+        if entry:
+            self.texture_ids, self.fb_ids = entry
+        else:
+            for name in self.texture_ids:
+                self.texture_ids[name] = gl.glGenTextures(1)
+                gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture_ids[name])
+                gl.glTexParameterf(gl.GL_TEXTURE_2D,
+                                   gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+                gl.glTexParameterf(gl.GL_TEXTURE_2D,
+                                   gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+                gl.glTexImage2D(
+                    gl.GL_TEXTURE_2D,
+                    0,
+                    gl.GL_RGBA8,
+                    img.size[0],
+                    img.size[1],
+                    0,
+                    gl.GL_RGBA,
+                    gl.GL_UNSIGNED_BYTE,
+                    None)
+
         image_bytes = img.convert("RGBA").tobytes("raw", "RGBA", 0, -1)
-        for name in self.texture_ids:
-            self.texture_ids[name] = gl.glGenTextures(1)
-            gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture_ids[name])
-            gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER,
-                               gl.GL_NEAREST)
-            gl.glTexParameterf(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER,
-                               gl.GL_NEAREST)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture_ids['img'])
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, 0, 0, img.size[0],
+                           img.size[1], gl.GL_RGBA, gl.GL_UNSIGNED_BYTE,
+                           image_bytes)
 
-            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+    def cleanup_readback_ring(self):
+        """
+        Destroy the readback pixel buffer objects, anything still pending is
+        dropped so flush first if it is needed
+        """
+        for v in self.readback_pbos:
+            gl.glDeleteBuffers(1, int(v))
+        self.readback_pbos = []
+        self.readback_pending = deque()
+        self.readback_index = 0
 
-            gl.glTexImage2D(
-                gl.GL_TEXTURE_2D,
-                0,
-                gl.GL_RGBA8,
-                img.size[0],
-                img.size[1],
-                0,
-                gl.GL_RGBA,
-                gl.GL_UNSIGNED_BYTE,
-                image_bytes)
-
-    def record(self, folder_name="mov"):
-        """
-        """
-        filename = "%s/%03d.png" % (folder_name, self.recording_frame_num)
-        self.console.add_output(
-            "Saved frame %s/%s" %
-            (self.recording_frame_num +
-             1,
-             self.recording_frame_num +
-             self.recording_remaining_frames))
+    def init_readback_ring(self):
+        """
+        Allocate readback_depth pixel buffer objects the size of the image
+        """
+        self.cleanup_readback_ring()
+        size = self.img_dimensions[0] * self.img_dimensions[1] * 4
+        for i in range(self.readback_depth):
+            pbo = gl.glGenBuffers(1)
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+            gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, size, None,
+                            gl.GL_STREAM_READ)
+            self.readback_pbos.append(pbo)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+    def set_noise_pool(self, size, layers=NOISE_POOL_LAYERS,
+                       seed=NOISE_POOL_SEED):
+        """
+        Rebuild the noise pool the static filters sample with size x size
+        texels per layer from seed. Cached passes used the old pool, so
+        they are dropped.
+        """
+        assert size > 0 and layers > 0, (
+            "Error: noise pool size and layers must be at least 1")
+        noise_pool.configure(size, layers, seed)
+        self.stage_cache.clear()
+        self.frame_ring.clear()
+
+    def set_readback_depth(self, depth):
+        """
+        Change how many frames can be in flight, pending frames are
+        finished and saved first
+        """
+        assert depth > 0, "Error: readback depth must be at least 1"
+        self.write_readbacks(self.flush_readback())
+        self.cleanup_readback_ring()
+        self.readback_depth = depth
+
+    def queue_readback(self, tag):
+        """
+        Start copying the filtered image into the next pixel buffer object
+        without waiting for it. When the ring is full the oldest frame is
+        finished first, returns a list of (tag, pixels) for finished frames.
+        """
+        if not self.readback_pbos:
+            self.init_readback_ring()
+        finished = []
+        if len(self.readback_pending) >= len(self.readback_pbos):
+            finished.append(self._finish_readback())
+
+        # Round robin means the buffer at readback_index is always the
+        # oldest one, which was just finished if the ring was full
+        pbo = self.readback_pbos[self.readback_index]
+        self.readback_index = (
+            (self.readback_index + 1) % len(self.readback_pbos))
+        self.frame_stats.begin("readback")
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.target_fb)
+        gl.glReadBuffer(gl.GL_COLOR_ATTACHMENT0)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+        gl.glReadPixels(0, 0, self.img_dimensions[0], self.img_dimensions[1],
+                        gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.frame_stats.end()
+        self.readback_pending.append((pbo, tag))
+        return finished
+
+    def flush_readback(self):
+        """
+        Finish every pending readback, returns a list of (tag, pixels) in the
+        order they were queued. Pixels are bottom up as read from opengl
+        """
+        finished = []
+        while self.readback_pending:
+            finished.append(self._finish_readback())
+        return finished
+
+    def _finish_readback(self):
+        pbo, tag = self.readback_pending.popleft()
+        size = self.img_dimensions[0] * self.img_dimensions[1] * 4
+        self.frame_stats.begin("readback map")
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+        ptr = gl.glMapBufferRange(gl.GL_PIXEL_PACK_BUFFER, 0, size,
+                                  gl.GL_MAP_READ_BIT)
+        pixels = ctypes.string_at(ptr, size)
+        gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.frame_stats.end()
+        return tag, pixels
+
+    def get_frame_writer(self):
+        """
+        Shared background writer for screenshots and unordered recordings
+        """
+        if not self.frame_writer:
+            self.frame_writer = FrameWriter(self.writer_threads,
+                                            self.writer_queue_len)
+        return self.frame_writer
+
+    def write_readbacks(self, finished):
+        """
+        Hand (frame_num, pixels) pairs returned from the readback ring to the
+        recording writer, blocks only if its queue is full
+        """
+        for frame_num, pixels in finished:
+            self.recording_jobs.submit(self.recording_writer,
+                                       self.recording_sink.write_frame,
+                                       frame_num, pixels,
+                                       self.img_dimensions)
+
+    def create_recording_sink(self, sink_name="png", options=None):
+        """
+        Create a sink for recorded frames. png writes numbered frames to a
+        folder, ffmpeg pipes raw frames into an encoder process. Raises
+        ValueError for unknown sinks or bad options.
+        """
+        options = dict(options or {})
+        if sink_name == "png":
+            return PngSink(options.pop("out", "mov"))
+        elif sink_name == "ffmpeg":
+            sink = EncoderSink(options.pop("out", "mov/output.webm"),
+                               self.img_dimensions,
+                               int(options.pop("fps", self.fps)),
+                               **{k: options.pop(k) for k in
+                                  ("codec", "quality", "bitrate")
+                                  if k in options})
+            if options:
+                sink.close()
+                raise ValueError("Unknown option %s" % (", ".join(options)))
+            return sink
+        raise ValueError("Unknown recording sink %s" % (sink_name))
+
+    def start_recording(self, num_frames, sink):
+        self.stop_recording()
+        self.finish_recording_writer()
+        self.recording_sink = sink
+        if sink.ordered:
+            self.recording_writer = FrameWriter(1, self.writer_queue_len)
+        else:
+            self.recording_writer = self.get_frame_writer()
+        self.recording_jobs = JobCounter()
+        self.recording_saved = 0
+        self.recording_total = num_frames
+        self.recording = True
+        self.recording_remaining_frames = num_frames
+        self.recording_frame_num = 0
+
+    def stop_recording(self):
+        """
+        Queue any frames still being read back and closing the sink, the
+        writer finishes them in the background
+        """
+        if self.recording_sink:
+            self.write_readbacks(self.flush_readback())
+            self.recording_jobs.submit(self.recording_writer,
+                                       self.recording_sink.close)
+            self.recording_sink = None
+        self.recording = False
+        self.recording_frame_num = 0
+        self.recording_remaining_frames = -1
+
+    def finish_recording_writer(self):
+        """
+        Wait for the last recording's frames to be written
+        """
+        if self.recording_writer:
+            self.recording_writer.wait()
+            self.report_recording_progress()
+
+    def report_recording_progress(self):
+        """
+        Print how many recorded frames have been written so far, called from
+        the render thread so it never waits on the writer. Returns True if
+        anything was printed.
+        """
+        writer = self.recording_writer
+        if not writer:
+            return False
+        saved_before = self.recording_saved
+        jobs = self.recording_jobs
+        errors = jobs.pop_errors()
+        for error in errors:
+            self.console.add_output("Error writing frame: %s" % (error))
+        # The sink close job counts as completed too
+        saved = min(jobs.completed, self.recording_total)
+        if saved > self.recording_saved:
+            self.recording_saved = saved
+            self.console.add_output("Saved frame %s/%s" %
+                                    (saved, self.recording_total))
+        if not self.recording and jobs.pending() == 0:
+            self.console.add_output("Done recording")
+            if writer is not self.frame_writer:
+                writer.close()
+            self.recording_writer = None
+            return True
+        return bool(errors) or self.recording_saved != saved_before
+
+    def record(self):
+        """
+        Queue the current frame for the recording sink, frames are written
+        once their readback finishes
+        """
+        self.write_readbacks(self.queue_readback(self.recording_frame_num))
         self.recording_frame_num += 1
         self.recording_remaining_frames -= 1
         if self.recording_remaining_frames <= 0:
-            self.console.add_output("Done recording")
-            self.recording = False
-            self.recording_frame_num = 0
-            self.recording_remaining_frames = -1
-        image = self.get_filter_img()
-        image.save(filename, compress_level=3)
-        image.close()
+            self.stop_recording()
+        self.report_recording_progress()
 
-    def get_filter_img(self):
+    def get_filter_pixels(self):
+        """
+        Read the filtered image, pixels are bottom up as stored by opengl.
+        The caller needs the pixels right away, so this reads directly
+        instead of through the readback ring.
+        """
         width = self.img_dimensions[0]
         height = self.img_dimensions[1]
+        self.frame_stats.begin("readback")
         gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.target_fb)
         gl.glReadBuffer(gl.GL_COLOR_ATTACHMENT0)
         pixels = gl.glReadPixels(
             0, 0, width, height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE)
+        self.frame_stats.end()
         #gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
-        image = Image.frombytes("RGBA", (width, height), pixels)
-        image = image.transpose(Image.FLIP_TOP_BOTTOM)
-        return image
+        return pixels
+
+    def get_filter_img(self):
+        return pixels_to_image(self.get_filter_pixels(), self.img_dimensions)
 
     def screenshot(self, filename):
         """
         bind the last framebuffer used during filtering and copy pixels to
-        image and save as filename
+        image, saving it as filename happens on the frame writer. Call
+        wait_for_writes to know it is on disk.
         """
-        image = self.get_filter_img()
-        image.save(filename, compress_level=3)
+        self.get_frame_writer().submit(save_png, filename,
+                                       self.get_filter_pixels(),
+                                       self.img_dimensions)
+
+    def wait_for_writes(self):
+        """
+        Block until all screenshots and recorded frames are saved, returns
+        any errors from writing them
+        """
+        self.finish_recording_writer()
+        if not self.frame_writer:
+            return []
+        self.frame_writer.wait()
+        return self.frame_writer.pop_errors()
 
     def update_filtered_image(self, update_frame_count=True):
         """
-        Update the image by processing it with all of the shaders.
+        Update the image by processing it with all of the shaders. Passes
+        whose output is already in the stage cache are skipped.
         """
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture_ids['img'])
+        passes = self.get_render_passes()
+
+        # Outputs can only be cached while no pass so far uses frame or rand
+        prefix_keys = []
+        indices = []
+        names = ()
+        for pass_names, val in passes:
+            indices.append(len(names))
+            names += pass_names
+            if val.deterministic and (not prefix_keys or prefix_keys[-1]):
+                prefix_keys.append(names)
+            else:
+                prefix_keys.append(None)
+
+        # Start after the longest prefix that is already rendered
+        start = 0
+        source_texture = self.texture_ids['img']
+        for i in reversed(range(len(passes))):
+            if prefix_keys[i] and prefix_keys[i] in self.stage_cache:
+                source_texture, source_fb = self.stage_cache.get(
+                    prefix_keys[i])
+                self.target_texture = source_texture
+                self.target_fb = source_fb
+                start = i + 1
+                break
+
         current_fb = [(x, y) for x, y in self.fb_texture_map.iteritems()]
-        for val in self.filters:
-            gl.glBindFramebuffer(
-                gl.GL_FRAMEBUFFER, self.fb_ids[current_fb[0][0]])
+        for i in range(start, len(passes)):
+            entry = None
+            if prefix_keys[i]:
+                entry = self.stage_cache.create(prefix_keys[i],
+                                                self.img_dimensions)
+            if entry:
+                texture, fb = entry
+            else:
+                fb = self.fb_ids[current_fb[0][0]]
+                texture = self.texture_ids[current_fb[0][1]]
+                current_fb = current_fb[1:] + current_fb[:1]
+            self.frame_stats.begin("+".join(passes[i][0]))
+            gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, fb)
             gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
-            val.render(self.img_dimensions, self.frame)
-            gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture_ids[
-                             current_fb[0][1]])
-            self.target_texture = self.texture_ids[current_fb[0][1]]
-            self.target_fb = self.fb_ids[current_fb[0][0]]
-            current_fb = current_fb[1:] + current_fb[:1]
+            # Bound after create, allocating a stage texture rebinds it
+            gl.glBindTexture(gl.GL_TEXTURE_2D, source_texture)
+            passes[i][1].render(self.img_dimensions, self.frame, self.seed,
+                                indices[i])
+            self.frame_stats.end()
+            gl.glBindTexture(gl.GL_TEXTURE_2D, texture)
+            source_texture = texture
+            self.target_texture = texture
+            self.target_fb = fb
+        self.frame_stats.tick('render')
+        self.frame_stats.collect()
+        self.shown_frame = self.frame
+        if self.filters:
+            self.frame_ring.store((self.frame, self.seed,
+                                   self.get_chain_key()),
+                                  self.target_fb, self.img_dimensions)
         if update_frame_count:
             self.frame += 1
             if self.recording:
-                self.record()
+                with self.tracer.span("record"):
+                    self.record()
         #gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
 
+    def show_frame(self, frame):
+        """
+        Present frame from the frame ring, it is only rendered if the ring
+        doesn't have it for the current chain
+        """
+        frame = max(frame, 0)
+        key = (frame, self.seed, self.get_chain_key())
+        if self.filters and key in self.frame_ring:
+            self.target_texture, self.target_fb = self.frame_ring.get(key)
+            self.shown_frame = frame
+        else:
+            self.frame = frame
+            self.update_filtered_image(update_frame_count=False)
+        self.frame = frame + 1
+
+    def next_loop_frame(self, step=1):
+        first, last = self.loop_range
+        if self.shown_frame < first or self.shown_frame > last:
+            return first
+        return first + (self.shown_frame - first + step) % (last - first + 1)
+
     def update_screen(self):
         """
         Updates what is on the screen.
         """
+        if not self.window:
+            return
         gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
 
         # This renders the filters into an orho view to allow
@@ -379,14 +1240,31 @@ class ImageGlitch:
         tar_tex = self.target_texture if self.filters else self.texture_ids[
             'img']
         gl.glBindTexture(gl.GL_TEXTURE_2D, tar_tex)
+        self.frame_stats.begin("present")
         self.final_filter.render(self.view.offset, self.view.zoom,
                                  self.window_dimensions, self.img_dimensions)
+        self.frame_stats.end()
 
         # This renders the console
         if self.console_enabled:
+            self.frame_stats.begin("console")
             self.console.render(self.window_dimensions)
+            self.frame_stats.end()
 
         sdl2.SDL_GL_SwapWindow(self.window)
+        self.frame_stats.tick('present')
+        self.frame_stats.collect()
+
+    def update_stats_overlay(self):
+        """
+        Put the rates and slowest stages in the window title
+        """
+        if not self.window or time.time() - self.stats_overlay_last < (
+                self.stats_overlay_interval):
+            return
+        self.stats_overlay_last = time.time()
+        title = " | ".join(self.frame_stats.summary())
+        sdl2.SDL_SetWindowTitle(self.window, title)
 
     def handle_resize(self, dimensions):
         """
@@ -422,8 +1300,8 @@ class ImageGlitch:
         elif cmd[:4] == 'add ':
             target = cmd[4:]
 
-            if target in self.all_filters:
-                self.filters.append(self.all_filters[target])
+            if target in ALL_FILTERS:
+                self.filters.append(self.get_filter(target))
                 self.console.add_output("Success adding filter %s." % (target))
                 update_image = True
             else:
@@ -460,24 +1338,46 @@ class ImageGlitch:
             except:
                 self.console.add_output("Could not load image %s" % (target))
             if img is not None:
-                filters = [k for k, v in self.all_filters.iteritems()
-                           for f in self.filters if v == f]
+                filters = [self.get_filter_name(f) for f in self.filters]
                 self.filter_img(img, filters)
                 img.close()
                 self.console.add_output("Success, loaded image %s" % (target))
             update_screen = True
         elif cmd[:7] == 'record ':
+            # record <frames> [png|ffmpeg] [out=.. codec=.. fps=.. quality=..]
+            args = cmd[7:].split()
             num_frames = None
+            sink = None
             try:
-                num_frames = int(cmd[7:])
+                num_frames = int(args[0])
             except:
                 self.console.add_output("Failed to parse int")
 
             if num_frames is not None:
-                self.console.add_output("Recording %s frames." % (num_frames))
-                self.recording = True
-                self.recording_remaining_frames = num_frames
-                self.recording_frame_num = 0
+                sink_name = args[1] if len(args) > 1 else "png"
+                try:
+                    options = dict(a.split('=', 1) for a in args[2:])
+                    sink = self.create_recording_sink(sink_name, options)
+                except (ValueError, OSError) as e:
+                    self.console.add_output("Could not start recording: %s" %
+                                            (e))
+            if sink is not None:
+                self.console.add_output("Recording %s frames to %s." %
+                                        (num_frames, sink.describe()))
+                self.start_recording(num_frames, sink)
+            update_screen = True
+        elif cmd[:9] == 'readback ':
+            depth = None
+            try:
+                depth = int(cmd[9:])
+            except:
+                self.console.add_output("Failed to parse int")
+            if depth is not None and depth < 1:
+                self.console.add_output("Readback depth must be at least 1")
+            elif depth is not None:
+                self.set_readback_depth(depth)
+                self.console.add_output(
+                    "Success, readback depth %s." % (depth))
             update_screen = True
         elif cmd[:4] == 'rem ':
             target = None
@@ -499,6 +1399,181 @@ class ImageGlitch:
                             :target] + self.filters[target + 1:]
                         update_image = True
             update_screen = True
+        elif cmd[:6] == 'cache ':
+            budget = None
+            try:
+                budget = int(cmd[6:])
+            except:
+                self.console.add_output("Failed to parse int")
+            if budget is not None:
+                self.stage_cache.set_budget(budget * 1024 * 1024)
+                self.console.add_output(
+                    "Success, stage cache budget %s MB." % (budget))
+                update_image = True
+            update_screen = True
+        elif cmd[:5] == 'pool ':
+            budget = None
+            try:
+                budget = int(cmd[5:])
+            except:
+                self.console.add_output("Failed to parse int")
+            if budget is not None:
+                self.target_pool.set_budget(budget * 1024 * 1024)
+                self.console.add_output(
+                    "Success, target pool budget %s MB." % (budget))
+            update_screen = True
+        elif cmd[:5] == 'font ':
+            size = None
+            try:
+                value = int(cmd[5:])
+                assert 4 <= value <= 128
+                size = value
+            except:
+                self.console.add_output("Failed to parse font size 4-128")
+            if size is not None:
+                size = self.console.set_font_size(size)
+                self.console.add_output("Success, font size %s." % (size))
+            update_screen = True
+        elif cmd[:7] == 'frames ':
+            budget = None
+            try:
+                budget = int(cmd[7:])
+            except:
+                self.console.add_output("Failed to parse int")
+            if budget is not None:
+                self.frame_ring.set_budget(budget * 1024 * 1024)
+                self.console.add_output(
+                    "Success, frame ring budget %s MB." % (budget))
+                update_image = True
+            update_screen = True
+        elif cmd[:5] == 'seed ':
+            seed = None
+            try:
+                seed = int(cmd[5:])
+            except:
+                self.console.add_output("Failed to parse int")
+            if seed is not None:
+                self.seed = seed
+                self.console.add_output("Success, seed %s." % (seed))
+                update_image = True
+            update_screen = True
+        elif cmd[:6] == 'noise ':
+            args = None
+            try:
+                args = [int(v) for v in cmd[6:].split()]
+                assert 1 <= len(args) <= 3 and min(args[:2]) > 0
+            except:
+                self.console.add_output(
+                    "Usage: noise SIZE [LAYERS] [SEED], sizes at least 1")
+                args = None
+            if args is not None:
+                self.set_noise_pool(*args)
+                self.console.add_output(
+                    "Success, noise pool %sx%s x %s layers, seed %s." % (
+                        noise_pool.pool_size, noise_pool.pool_size,
+                        noise_pool.pool_layers, noise_pool.pool_seed))
+                update_image = True
+            update_screen = True
+        elif cmd == 'stats':
+            self.frame_stats.collect()
+            self.console.add_output("\n".join(self.frame_stats.summary()))
+            update_screen = True
+        elif cmd in ('stats on', 'stats off'):
+            self.stats_overlay = cmd == 'stats on'
+            # Off also stops issuing timer queries, stats shows the last ones
+            self.frame_stats.enabled = self.stats_overlay
+            if not self.stats_overlay and self.window:
+                sdl2.SDL_SetWindowTitle(self.window, WINDOW_TITLE)
+            self.console.add_output(
+                "Success. Stats overlay: %s" % self.stats_overlay)
+            update_screen = True
+        elif cmd == 'trace off':
+            if self.tracer.enabled:
+                num_events = self.tracer.stop()
+                if self.tracer.error:
+                    self.console.add_output("Could not write %s: %s" % (
+                        self.tracer.filename, self.tracer.error))
+                else:
+                    self.console.add_output(
+                        "Success, wrote %s events to %s." % (
+                            num_events, self.tracer.filename))
+            else:
+                self.console.add_output("Not tracing.")
+            update_screen = True
+        elif cmd == 'trace on' or cmd[:9] == 'trace on ':
+            filename = cmd[9:].strip() or DEF_TRACE_FILE
+            self.tracer.stop()
+            if self.tracer.error:
+                self.console.add_output("Could not write %s: %s" % (
+                    self.tracer.filename, self.tracer.error))
+            self.tracer.start(filename)
+            self.console.add_output("Success, tracing to %s." % (filename))
+            update_screen = True
+        elif cmd == 'fps':
+            self.console.add_output(
+                self.frame_scheduler.report(sdl2.SDL_GetTicks()))
+            update_screen = True
+        elif cmd[:4] == 'fps ':
+            target = cmd[4:]
+            if target in FrameScheduler.POLICIES:
+                self.frame_scheduler.policy = target
+                self.console.add_output("Success, %s late frames." % (target))
+            else:
+                fps = None
+                try:
+                    fps = float(target)
+                except:
+                    self.console.add_output("Failed to parse fps")
+                if fps is not None:
+                    if fps <= 0:
+                        self.console.add_output("fps has to be above 0!")
+                    else:
+                        self.fps = fps
+                        self.frame_scheduler.set_fps(fps)
+                        self.frame_scheduler.stop(sdl2.SDL_GetTicks())
+                        self.console.add_output("Success, %s fps." % (fps))
+            update_screen = True
+        elif cmd == 'loop off':
+            self.loop_range = None
+            self.console.add_output("Success, stopped looping.")
+            update_screen = True
+        elif cmd[:5] == 'loop ':
+            targets = cmd[5:].split(' ')
+            loop_range = None
+            try:
+                loop_range = (int(targets[0]), int(targets[1]))
+            except:
+                self.console.add_output("Could not parse loop range!")
+            if loop_range is not None:
+                if loop_range[0] < 0 or loop_range[1] < loop_range[0]:
+                    self.console.add_output("That range is out of bounds!")
+                else:
+                    self.loop_range = loop_range
+                    self.playing = True
+                    self.console.add_output(
+                        "Success, looping frames %s to %s." % loop_range)
+            update_screen = True
+        elif cmd == 'back':
+            self.show_frame(self.shown_frame - 1)
+            self.console.add_output("Success, frame %s." % (self.shown_frame))
+            update_screen = True
+        elif cmd[:5] == 'jump ':
+            target = None
+            try:
+                target = int(cmd[5:])
+            except:
+                self.console.add_output("Could not parse int!")
+            if target is not None:
+                self.show_frame(target)
+                self.console.add_output(
+                    "Success, frame %s." % (self.shown_frame))
+            update_screen = True
+        elif cmd in ('fuse on', 'fuse off'):
+            self.fuse_filters = cmd == 'fuse on'
+            self.console.add_output(
+                "Success. Fusing filters: %s" % self.fuse_filters)
+            update_image = True
+            update_screen = True
         elif cmd == 'list':
             for i in range(len(self.filters)):
                 self.console.add_output("%d %s" % (i, str(self.filters[i])))
@@ -514,7 +1589,7 @@ class ImageGlitch:
             update_screen = True
         elif cmd == 'screenshot':
             self.screenshot('out.png')
-            self.console.add_output("Success, saved out.png.")
+            self.console.add_output("Success, saving out.png.")
             update_screen = True
         elif cmd == 'stop':
             self.playing = False
@@ -525,34 +1600,88 @@ class ImageGlitch:
             update_screen = True
         return update_image, update_screen, update_frame_count
 
-    def run(self):
-        run, update_img, update_view, update_frame = self.poll_events()
+    def get_wait_timeout(self):
+        """
+        How many ms the loop can sleep waiting for events: until the next
+        frame is due when playing, otherwise until the next time something
+        in the background needs checking
+        """
+        if self.playing:
+            if not self.frame_scheduler.running:
+                return 0
+            return int(math.ceil(self.frame_scheduler.time_until_due(
+                sdl2.SDL_GetTicks())))
+        if self.recording_writer or self.stats_overlay:
+            return self.busy_timeout
+        return self.idle_timeout
 
-        if (run and self.playing and
-                sdl2.SDL_GetTicks() - self.last_update > 1000 / self.fps):
-            self.update_filtered_image()
-            self.last_update = sdl2.SDL_GetTicks()
-            self.update_screen()
+    def run(self):
+        tracer = self.tracer
+        with tracer.span("poll_events"):
+            run, update_img, update_view, update_frame = self.poll_events(
+                self.get_wait_timeout())
+
+        steps = 0
+        if run and self.playing:
+            now = sdl2.SDL_GetTicks()
+            if not self.frame_scheduler.running:
+                self.frame_scheduler.start(now)
+            steps = self.frame_scheduler.tick(now, not self.recording)
+        else:
+            self.frame_scheduler.stop(sdl2.SDL_GetTicks())
+
+        if steps:
+            if self.loop_range:
+                with tracer.span("show_frame"):
+                    self.show_frame(self.next_loop_frame(steps))
+                # Looped frames are recorded as they are presented
+                if self.recording:
+                    with tracer.span("record"):
+                        self.record()
+            else:
+                # Dropped frames still move the animation forward
+                self.frame += steps - 1
+                with tracer.span("update_filtered_image"):
+                    self.update_filtered_image()
+            with tracer.span("update_screen"):
+                self.update_screen()
         else:
             if update_img:
-                self.update_filtered_image(
-                    update_frame_count=update_frame)
+                with tracer.span("update_filtered_image"):
+                    self.update_filtered_image(
+                        update_frame_count=update_frame)
             if update_view:
-                self.update_screen()
+                with tracer.span("update_screen"):
+                    self.update_screen()
 
-        delay = 10
-        sdl2.SDL_Delay(delay)
+        with tracer.span("housekeeping"):
+            if self.recording_writer and not self.recording:
+                # frames still being written after recording ended
+                if (self.report_recording_progress() and
+                        self.console_enabled):
+                    self.update_screen()
+
+            if self.stats_overlay:
+                self.frame_stats.collect()
+                self.update_stats_overlay()
+
+            self.evict_idle_filters()
         return run
 
-    def poll_events(self):
+    def poll_events(self, timeout=0):
         """
-        Wait for a SDL2 event, handle it once encountered
+        Wait up to timeout ms for a SDL2 event, then handle every queued one
         """
         update_img = False
         update_view = False
         update_frame = False
         event = sdl2.SDL_Event()
-        while sdl2.SDL_PollEvent(ctypes.byref(event)):
+        if timeout > 0:
+            has_event = sdl2.SDL_WaitEventTimeout(ctypes.byref(event),
+                                                  timeout)
+        else:
+            has_event = sdl2.SDL_PollEvent(ctypes.byref(event))
+        while has_event:
             # resize events
             if event.type == sdl2.SDL_WINDOWEVENT:
                 if event.window.event == sdl2.SDL_WINDOWEVENT_RESIZED:
@@ -580,8 +1709,10 @@ class ImageGlitch:
                         commands += self.console.parse_input('\n')
                         update_view = True
                 for cmd in commands:
-                    update_img, update_view, update_frame = self.do_command(
-                        cmd)
+                    with self.tracer.span("do_command", "command",
+                                          {"cmd": cmd}):
+                        update_img, update_view, update_frame = (
+                            self.do_command(cmd))
 
             # hotkeys
             if event.type == sdl2.events.SDL_KEYDOWN:
@@ -631,25 +1762,53 @@ class ImageGlitch:
                     self.view.zoom -= 0.05
                     update_view = True
 
+            has_event = sdl2.SDL_PollEvent(ctypes.byref(event))
+
         return True, update_img, update_view, update_frame
 
     def cleanup(self):
         """
         destroys opengl and sdl resources allocated
         """
+        if self.tracer:
+            self.tracer.stop()
+            if self.tracer.error:
+                # No console left to show it in
+                print("Could not write %s: %s" % (self.tracer.filename,
+                                                  self.tracer.error))
+                self.tracer.error = None
+        self.stop_recording()
+        self.wait_for_writes()
+        if self.frame_writer:
+            self.frame_writer.close()
+            self.frame_writer = None
         for val in self.all_filters.itervalues():
             val.cleanup_shader()
+        self.cleanup_fused_filters()
+        if self.stage_cache:
+            self.stage_cache.clear()
+        if self.target_pool:
+            self.target_pool.clear()
+        if self.frame_ring:
+            self.frame_ring.clear()
+        if self.frame_stats:
+            self.frame_stats.cleanup()
+        noise_pool.cleanup()
         self.filters = []
         if self.final_filter:
             self.final_filter.cleanup_shader()
         if self.console:
             self.console.cleanup()
         self.final_filter = None
+        self.cleanup_readback_ring()
         self.cleanup_img_fb()
         self.cleanup_image_texture()
         if self.window:
             sdl2.SDL_DestroyWindow(self.window)
             self.window = None
+        if self.headless_context:
+            self.headless_context.destroy()
+            self.headless_context = None
         self.view.reset()
 
     def __del__(self):
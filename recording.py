@@ -0,0 +1,219 @@
+import os
+import subprocess
+import threading
+from PIL import Image
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+DEF_ENCODER_CODEC = "libvpx"
+
+DEF_ENCODER_QUALITY = 10  # crf
+
+DEF_ENCODER_BITRATE = "1M"
+
+
+def pixels_to_image(pixels, dimensions):
+    """
+    Wrap bottom up gl pixels in an image, the negative stride flips rows
+    while decoding so there is no separate transpose copy
+    """
+    return Image.frombuffer("RGBA", dimensions, pixels, "raw", "RGBA", 0, -1)
+
+
+def save_png(filename, pixels, dimensions):
+    image = pixels_to_image(pixels, dimensions)
+    image.save(filename, compress_level=3)
+    image.close()
+
+
+class FrameWriter:
+    """
+    Encodes and writes frames on a bounded pool of background threads.
+    Pixels are handed over as is, submit blocks once max_pending jobs are
+    waiting so a slow disk or encoder holds back rendering instead of
+    buffering frames without limit. Sinks that need frames in order should
+    get a writer with a single thread.
+    """
+    def __init__(self, num_threads=2, max_pending=8):
+        self.queue = Queue(max_pending)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.errors = []
+        self.threads = []
+        for i in range(num_threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            func, args = job
+            try:
+                func(*args)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(str(e))
+            finally:
+                with self.lock:
+                    self.completed += 1
+                self.queue.task_done()
+
+    def submit(self, func, *args):
+        with self.lock:
+            self.submitted += 1
+        self.queue.put((func, args))
+
+    def pending(self):
+        with self.lock:
+            return self.submitted - self.completed
+
+    def pop_errors(self):
+        with self.lock:
+            errors = self.errors
+            self.errors = []
+        return errors
+
+    def wait(self):
+        """
+        Block until every submitted job has finished
+        """
+        self.queue.join()
+
+    def close(self):
+        """
+        Finish submitted jobs and stop the threads
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class JobCounter:
+    """
+    Counts and collects errors of one group of jobs on a FrameWriter, so a
+    recording that shares the writer with screenshots only reports its own
+    frames
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.errors = []
+
+    def submit(self, writer, func, *args):
+        with self.lock:
+            self.submitted += 1
+        writer.submit(self._run, func, args)
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(str(e))
+        finally:
+            with self.lock:
+                self.completed += 1
+
+    def pending(self):
+        with self.lock:
+            return self.submitted - self.completed
+
+    def pop_errors(self):
+        with self.lock:
+            errors = self.errors
+            self.errors = []
+        return errors
+
+
+class PngSink:
+    """
+    Saves every recorded frame as a numbered png in a folder
+    """
+    # Frames can change size between loads
+    fixed_size = False
+
+    # Each frame is its own file so they can be written in any order
+    ordered = False
+
+    def __init__(self, folder_name="mov"):
+        self.folder_name = folder_name
+        if not os.path.isdir(folder_name):
+            os.makedirs(folder_name)
+
+    def describe(self):
+        return "png frames in %s" % (self.folder_name)
+
+    def write_frame(self, frame_num, pixels, dimensions):
+        save_png("%s/%05d.png" % (self.folder_name, frame_num),
+                 pixels, dimensions)
+
+    def close(self):
+        pass
+
+
+class EncoderSink:
+    """
+    Pipes raw RGBA frames into an ffmpeg process's stdin, skipping the png
+    encode and decode. Frames are passed bottom up as read from opengl and
+    flipped by ffmpeg.
+    """
+    fixed_size = True
+
+    ordered = True
+
+    process = None
+
+    def __init__(self, filename, dimensions, framerate,
+                 codec=DEF_ENCODER_CODEC, quality=DEF_ENCODER_QUALITY,
+                 bitrate=DEF_ENCODER_BITRATE):
+        self.filename = filename
+        self.dimensions = dimensions
+        self.codec = codec
+        folder_name = os.path.dirname(filename)
+        if folder_name and not os.path.isdir(folder_name):
+            os.makedirs(folder_name)
+        cmd = ["ffmpeg", "-y", "-loglevel", "error",
+               "-f", "rawvideo",
+               "-pix_fmt", "rgba",
+               "-s", "%dx%d" % (dimensions[0], dimensions[1]),
+               "-framerate", str(framerate),
+               "-i", "-",
+               "-vf", "vflip",
+               "-c:v", codec,
+               "-crf", str(quality)]
+        if bitrate:
+            cmd += ["-b:v", str(bitrate)]
+        if codec == "libvpx":
+            cmd += ["-auto-alt-ref", "0"]
+        if codec in ("libx264", "libx265"):
+            cmd += ["-pix_fmt", "yuv420p"]
+        cmd.append(filename)
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def describe(self):
+        return "%s with %s" % (self.filename, self.codec)
+
+    def write_frame(self, frame_num, pixels, dimensions):
+        assert dimensions == self.dimensions, (
+            "Error: encoder expects %sx%s frames" % self.dimensions)
+        self.process.stdin.write(pixels)
+
+    def close(self):
+        """
+        Finish the stream and wait for the encoder to write the file
+        """
+        if self.process:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
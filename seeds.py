@@ -0,0 +1,34 @@
+import binascii
+import hashlib
+import random
+import struct
+
+DEF_SEED = 0
+
+# The noise pool filters sample instead of hashing, noise is tiled every
+# size pixels and each draw picks a layer and offset from its rand
+NOISE_POOL_SIZE = 512
+
+NOISE_POOL_LAYERS = 4
+
+NOISE_POOL_SEED = 0
+
+
+def frame_rand(seed, frame, index):
+    """
+    The rand uniform for the filter at index in the chain on frame, in
+    [0, 1). It only depends on its arguments, so any frame can be rendered
+    again, out of order or in another process and come out the same.
+    """
+    digest = hashlib.sha1(struct.pack("<qqq", seed, frame, index)).digest()
+    return struct.unpack("<I", digest[:4])[0] / 4294967296.0
+
+
+def generate_noise(size, layers, seed):
+    """
+    Returns size * size * layers 16 bit noise values as bytes, the same for a
+    given seed
+    """
+    num_bytes = size * size * layers * 2
+    bits = random.Random(seed).getrandbits(num_bytes * 8)
+    return binascii.unhexlify("%0*x" % (num_bytes * 2, bits))
@@ -18,3 +18,4 @@ ALL_FILTERS = {'first': FirstFilter,
 # These are special shaders that probably won't work for filtering
 from filter_ortho import OrthoFilter
 from filter_console import ConsoleFilter
+from filter_fused import FusedFilter, split_fusable_runs
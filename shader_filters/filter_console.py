@@ -1,4 +1,6 @@
 import ctypes
+import logging
+import operator
 from OpenGL import GL as gl
 from OpenGL.GL import shaders
 from shader_filter import (ShaderFilter, TEXTURE_VERTICES,
@@ -6,29 +8,60 @@ from shader_filter import (ShaderFilter, TEXTURE_VERTICES,
 from array import array
 import sdl2
 from PIL import Image
+import font_atlas
+
+log = logging.getLogger(__name__)
+
+# Fallback when the atlas can't be loaded or built, it only has one size
+PNG_FONT_PATH = 'font/font_tex.png'
+
+PNG_FONT_SIZE = 16
+
+# Corners of the quad every glyph instance is drawn with, a triangle strip
+UNIT_QUAD = array("f", [0.0, 0.0,
+                        1.0, 0.0,
+                        0.0, 1.0,
+                        1.0, 1.0]).tostring()
+
+# Words per glyph instance: x | char << 16, line, rgba8 color
+GLYPH_WORDS = 3
+
+WHITE = 0xffffffff
+
+# Char code part of a glyph's first word for every byte, lines are laid out
+# by looking codes up here instead of building each glyph in python
+CHAR_WORDS = array("I", [code << 16 for code in range(256)])
 
 VERT_SOURCE = """
 #version 330
 
-uniform mat4 model_matrix;
 uniform mat4 view_matrix;
 uniform mat4 proj_matrix;
+uniform vec2 glyph_size;
+uniform uint scroll;
 
-in vec2 vert_coord;
-in vec2 vert_tex_coord;
-in vec4 vert_color;
+in vec2 vert_corner;
+in uvec3 glyph;
 out vec2 frag_tex_coord;
 out vec4 frag_color;
 void main()
 {
-    mat4 _model_matrix = model_matrix;
-    _model_matrix[3][0] = vert_coord.x;
-    _model_matrix[3][1] = vert_coord.y;
-    mat4 mv_matrix = view_matrix * _model_matrix;
-    vec4 cc_vertex = mv_matrix * vec4(0.0, 0.0, 0.0, 1.0);
-    frag_tex_coord = vert_tex_coord;
-    frag_color = vert_color;
-    gl_Position = proj_matrix * cc_vertex;
+    uint char_code = (glyph.x >> 16) & 255u;
+    // Lines above the bottom one, uint math so the line counter can wrap
+    float rows_up = float(int(scroll - glyph.y));
+    vec2 pos = vec2(float(glyph.x & 65535u), rows_up * glyph_size.y) +
+        vert_corner * glyph_size;
+    frag_tex_coord = (vec2(float(char_code % 16u), float(char_code / 16u)) +
+                      vec2(vert_corner.x, 1.0 - vert_corner.y)) / 16.0;
+    frag_color = vec4(float((glyph.z >> 24) & 255u),
+                      float((glyph.z >> 16) & 255u),
+                      float((glyph.z >> 8) & 255u),
+                      float(glyph.z & 255u)) / 255.0;
+    gl_Position = proj_matrix * view_matrix * vec4(pos, 1.0, 1.0);
+    if (glyph.z == 0u) {
+        // Empty slot, put it outside the clip volume
+        gl_Position = vec4(2.0, 2.0, 2.0, 1.0);
+    }
 }"""
 
 FRAG_SOURCE = """
@@ -92,53 +125,61 @@ def get_view_matrix(x, y):
 
 
 class ConsoleFilter(ShaderFilter):
+    """
+    Draws console text as instances of a unit quad, one per glyph. Each
+    glyph is a GLYPH_WORDS uint record (x and char code, line, color) that
+    the vertex shader turns into a quad, position and texture coordinates.
+    Glyphs live in a preallocated ring of hard_limit_chars slots, once it is
+    full new glyphs replace the oldest ones. Only the slots written since
+    the last upload are sent to the gpu with glBufferSubData.
+
+    The font comes from the raw atlas in font_atlas at font_size, uploaded
+    as single channel coverage. The png atlas is the fallback.
+
+    Each glyph is placed on the line it was written on, a new line only
+    moves the scroll uniform up a line instead of moving every glyph.
+    """
     hard_limit_chars = 10000
 
-    colors = array("f")
-
-    coords = array("f")
-
-    tex_coords = array("f")
-
-    indexes = array("I")
-
     attrib_locs = {
-        "vert_coord": -1,
-        "vert_tex_coord": -1,
-        "vert_color": -1,
+        "vert_corner": -1,
+        "glyph": -1,
     }
 
     uniform_locs = {
-        "model_matrix": -1,
         "view_matrix": -1,
         "proj_matrix": -1,
-    }
-
-    bufferss = {
-        "vert_coord": -1,
-        "vert_tex_coord": -1,
-        "vert_color": -1,
-    }
-
-    index_buffers = {
-        "vert_indexes": -1,
-    }
-
-    texture_ids = {
-        "font": -1,
+        "glyph_size": -1,
+        "scroll": -1,
     }
 
     img_dimensions = (-1, -1)
 
-    def __init__(self):
+    def __init__(self, font_size=font_atlas.DEF_FONT_SIZE):
+        self.font_size = font_size
+        self.capacity = self.hard_limit_chars
+        self.glyphs = array('I', [0]) * (GLYPH_WORDS * self.capacity)
+        self.head = 0  # slot the next glyph goes in
+        self.count = 0  # glyphs that can still be backspaced
+        self.filled = 0  # slots in use, the ones drawn
+        self.dirty = []  # [first, last) slot ranges to upload
+        self.line = 0  # line new glyphs go on, the bottom one
+        self.buffers = {
+            "vert_corner": -1,
+            "glyph": -1,
+        }
+        self.texture_ids = {
+            "font": -1,
+        }
         self.init_shader()
         self.init_font_texture()
 
     def init_font_texture(self):
-        img = Image.open('font/font_tex.png')
-        image_bytes = img.convert("RGBA").tobytes("raw", "RGBA", 0 - 1)
-        self.img_dimensions = img.size
-        img.close()
+        try:
+            atlas = font_atlas.get_atlas(self.font_size)
+        except Exception as e:
+            log.warning("Font atlas unavailable, using the png: %s", e)
+            atlas = None
         self.texture_ids['font'] = gl.glGenTextures(1)
         gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture_ids['font'])
         gl.glTexParameter(gl.GL_TEXTURE_2D,
@@ -146,83 +187,90 @@ class ConsoleFilter(ShaderFilter):
         gl.glTexParameter(gl.GL_TEXTURE_2D,
                           gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
         gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        if atlas:
+            self.img_dimensions, coverage = atlas
+            # White with the coverage as alpha, like the png
+            gl.glTexParameteriv(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_SWIZZLE_RGBA,
+                                [gl.GL_ONE, gl.GL_ONE, gl.GL_ONE, gl.GL_RED])
+            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_R8,
+                            self.img_dimensions[0], self.img_dimensions[1],
+                            0, gl.GL_RED, gl.GL_UNSIGNED_BYTE, coverage)
+            return
+        img = Image.open(PNG_FONT_PATH)
+        image_bytes = img.convert("RGBA").tobytes("raw", "RGBA", 0, -1)
+        self.img_dimensions = img.size
+        self.font_size = PNG_FONT_SIZE
+        img.close()
         gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA8,
                         self.img_dimensions[0], self.img_dimensions[1], 0,
                         gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, image_bytes)
 
-    def backspace(self, n=1):
-        self.indexes = self.indexes[:n*-6]
-        self.coords = self.coords[:n*-2*4]
-        self.tex_coords = self.tex_coords[:n*-2*4]
-        self.colors = self.colors[:n*-4*4]
+    def _mark_dirty(self, first, last):
+        if self.dirty and self.dirty[-1][1] == first:
+            self.dirty[-1][1] = last
+        else:
+            self.dirty.append([first, last])
 
-    def _add_text(self, text, offset):
+    def backspace(self, n=1):
         """
-        Only used for adding strings with no newlines
+        Remove the last n glyphs, their slots are emptied
         """
-        x = 0
-        y = 0
-        font_height = self.img_dimensions[1] / 16
+        empty = array('I', [0] * GLYPH_WORDS)
+        for i in range(min(n, self.count)):
+            self.head = (self.head - 1) % self.capacity
+            slot = self.head
+            self.glyphs[GLYPH_WORDS*slot:GLYPH_WORDS*(slot+1)] = empty
+            self._mark_dirty(slot, slot + 1)
+        self.count = max(self.count - n, 0)
+
+    def _layout(self, text, x):
+        """
+        Glyph records for text with no newlines, starting at x on the
+        current line. Characters past the 16 bit x range are cut off.
+        """
+        if not isinstance(text, bytes):
+            text = text.encode('latin-1', 'replace')
         font_width = self.img_dimensions[0] / 16
-        font_frac = 1.0 / 16.0
-        for char in text:
-            i = len(self.coords)/2
-            tex_x = int(ord(char) % 16) * font_frac
-            tex_y = int(ord(char)/16) * font_frac
-            self.indexes += array("I", [i+1,     # 0,0
-                                        i+3,     # 1,0
-                                        i+2,     # 1,1
-                                        i,       # 0,1
-                                        i+1,     # 0,0
-                                        i+2, ])  # 1,1
-
-            self.coords += array('f', [x+offset[0], y+offset[1]+font_height,
-                                       x+offset[0], y+offset[1],
-                                       x+offset[0]+font_width,
-                                       y+offset[1]+font_height,
-                                       x+offset[0]+font_width, y+offset[1], ])
-
-            self.tex_coords += array('f', [tex_x, tex_y,
-                                           tex_x, tex_y+font_frac,
-                                           tex_x+font_frac, tex_y,
-                                           tex_x+font_frac, tex_y+font_frac, ])
-
-            self.colors += array('f', [1.0, 1.0, 1.0, 1.0,
-                                       1.0, 1.0, 1.0, 1.0,
-                                       1.0, 1.0, 1.0, 1.0,
-                                       1.0, 1.0, 1.0, 1.0, ])
-
-            x += font_width
-
-        num_chars = len(self.indexes)/6
-        if num_chars > self.hard_limit_chars:
-            # truncate a bit more to limit array resizing
-            target_shrink = self.hard_limit_chars - 3000
-            self.indexes = self.indexes[-6 * target_shrink:]
-            self.coords = self.coords[2 * -4 * target_shrink:]
-            self.tex_coords = self.tex_coords[2*-4*target_shrink:]
-            self.colors = self.colors[4*-4*target_shrink:]
-            self.indexes = array(
-                'I', [i-(num_chars-target_shrink)*4 for i in self.indexes])
+        codes = bytearray(text[:max(0, (0xffff - x) // font_width)])
+        words = array('I', [WHITE]) * (GLYPH_WORDS * len(codes))
+        if codes:
+            words[0::GLYPH_WORDS] = array('I', map(
+                operator.or_, map(CHAR_WORDS.__getitem__, codes),
+                range(x, x + len(codes) * font_width, font_width)))
+            words[1::GLYPH_WORDS] = array('I', [self.line]) * len(codes)
+        return words
+
+    def _write_glyphs(self, words):
+        """
+        Copy glyph records into the ring at head, in at most two slices
+        when it wraps around
+        """
+        words = words[-GLYPH_WORDS * self.capacity:]
+        while words:
+            slot = self.head
+            n = min(len(words) // GLYPH_WORDS, self.capacity - slot)
+            self.glyphs[GLYPH_WORDS*slot:GLYPH_WORDS*(slot+n)] = (
+                words[:GLYPH_WORDS*n])
+            words = words[GLYPH_WORDS*n:]
+            self._mark_dirty(slot, slot + n)
+            self.head = (slot + n) % self.capacity
+            self.count = min(self.count + n, self.capacity)
+            self.filled = max(self.filled, slot + n)
 
     def _shift_up(self):
-        char_height = self.img_dimensions[1]/16
-        for i in range(1, len(self.coords), 2):
-            self.coords[i] += char_height
+        self.line = (self.line + 1) & 0xffffffff
 
     def add_str(self, s, offset):
         """
-        Used to add a string typed from the used to the console
+        Used to add a string typed from the used to the console, every line
+        starts at offset. All of it is written and uploaded as one batch.
         """
-        text = s
-        while "\n" in text:
-            text_split = text.split('\n', 1)
-            t = text_split[0]
-            self._add_text(t, offset)
-            self._shift_up()
-            text = text_split[1]
-
-        self._add_text(text, offset)
+        words = array('I')
+        for i, text in enumerate(s.split('\n')):
+            if i:
+                self._shift_up()
+            words += self._layout(text, int(offset[0]))
+        self._write_glyphs(words)
         self.update_buffer_data()
 
     def cleanup_shader(self):
@@ -246,18 +294,10 @@ class ConsoleFilter(ShaderFilter):
 
     def init_shader(self):
         """
-        set up the console text shader
+        set up the console text shader, the glyph buffer is allocated for
+        the whole ring once
         """
-        vert_prog = self._compile_shader(VERT_SOURCE, gl.GL_VERTEX_SHADER)
-        frag_prog = self._compile_shader(FRAG_SOURCE, gl.GL_FRAGMENT_SHADER)
-        self.shader = gl.glCreateProgram()
-        gl.glAttachShader(self.shader, vert_prog)
-        gl.glAttachShader(self.shader, frag_prog)
-
-        gl.glLinkProgram(self.shader)
-        assert (gl.glGetProgramiv(self.shader, gl.GL_LINK_STATUS) ==
-                gl.GL_TRUE), (
-            "Error: %s" % (gl.glGetProgramInfoLog(self.shader)))
+        self.shader = self._create_program(VERT_SOURCE, FRAG_SOURCE)
         self.attrib_locs = {
             name: gl.glGetAttribLocation(self.shader, name)
             for name in self.attrib_locs
@@ -269,54 +309,47 @@ class ConsoleFilter(ShaderFilter):
 
         self.vao = gl.glGenVertexArrays(1)
         gl.glBindVertexArray(self.vao)
-        self.buffers['vert_coord'] = gl.glGenBuffers(1)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers['vert_coord'])
-        gl.glVertexAttribPointer(self.attrib_locs['vert_coord'], 2,
+        self.buffers['vert_corner'] = gl.glGenBuffers(1)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers['vert_corner'])
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, len(UNIT_QUAD), UNIT_QUAD,
+                        gl.GL_STATIC_DRAW)
+        gl.glVertexAttribPointer(self.attrib_locs['vert_corner'], 2,
                                  gl.GL_FLOAT, False, 0, ctypes.c_void_p(0))
-        gl.glEnableVertexAttribArray(self.attrib_locs['vert_coord'])
-
-        self.buffers['vert_tex_coord'] = gl.glGenBuffers(1)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers['vert_tex_coord'])
-        gl.glVertexAttribPointer(self.attrib_locs['vert_tex_coord'], 2,
-                                 gl.GL_FLOAT, False, 0, ctypes.c_void_p(0))
-        gl.glEnableVertexAttribArray(self.attrib_locs['vert_tex_coord'])
-
-        self.buffers['vert_color'] = gl.glGenBuffers(1)
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers['vert_color'])
-        gl.glVertexAttribPointer(self.attrib_locs['vert_color'], 4,
-                                 gl.GL_FLOAT, False, 0, ctypes.c_void_p(0))
-        gl.glEnableVertexAttribArray(self.attrib_locs['vert_color'])
-
-        self.index_buffers['vert_indexes'] = gl.glGenBuffers(1)
-        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER,
-                        self.index_buffers['vert_indexes'])
+        gl.glEnableVertexAttribArray(self.attrib_locs['vert_corner'])
+
+        self.buffers['glyph'] = gl.glGenBuffers(1)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers['glyph'])
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, self.glyphs.tostring(),
+                        gl.GL_DYNAMIC_DRAW)
+        gl.glVertexAttribIPointer(self.attrib_locs['glyph'], GLYPH_WORDS,
+                                  gl.GL_UNSIGNED_INT, 0, ctypes.c_void_p(0))
+        gl.glVertexAttribDivisor(self.attrib_locs['glyph'], 1)
+        gl.glEnableVertexAttribArray(self.attrib_locs['glyph'])
         gl.glActiveTexture(gl.GL_TEXTURE0)
 
     def clear(self):
-        self.coords = array('f')
-        self.tex_coords = array('f')
-        self.colors = array('f')
-        self.indexes = array('I')
+        self.head = 0
+        self.count = 0
+        self.filled = 0
+        self.dirty = []
+        self.line = 0
 
     def update_buffer_data(self):
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers['vert_coord'])
-        gl.glBufferData(gl.GL_ARRAY_BUFFER,
-                        self.coords.tostring(), gl.GL_STATIC_DRAW)
-
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers['vert_tex_coord'])
-        gl.glBufferData(gl.GL_ARRAY_BUFFER,
-                        self.tex_coords.tostring(), gl.GL_STATIC_DRAW)
-
-        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers['vert_color'])
-        gl.glBufferData(gl.GL_ARRAY_BUFFER,
-                        self.colors.tostring(), gl.GL_STATIC_DRAW)
-
-        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER,
-                        self.index_buffers['vert_indexes'])
-        gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER,
-                        self.indexes.tostring(), gl.GL_STATIC_DRAW)
+        """
+        Upload the slots written since the last upload
+        """
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.buffers['glyph'])
+        size = GLYPH_WORDS * self.glyphs.itemsize
+        for first, last in self.dirty:
+            gl.glBufferSubData(
+                gl.GL_ARRAY_BUFFER, first * size, (last - first) * size,
+                self.glyphs[GLYPH_WORDS*first:GLYPH_WORDS*last].tostring())
+        self.dirty = []
 
     def render(self, offset, window_dimensions):
+        # Backspaced slots are only marked dirty, upload them before drawing
+        if self.dirty:
+            self.update_buffer_data()
         font_height = self.img_dimensions[1] / 16
         font_width = self.img_dimensions[0] / 16
         gl.glBindVertexArray(self.vao)
@@ -324,19 +357,14 @@ class ConsoleFilter(ShaderFilter):
                       window_dimensions[1])
         gl.glUseProgram(self.shader)
         gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture_ids['font'])
-        view_matrix = get_view_matrix(1.0, 1.0)
+        view_matrix = get_view_matrix(1.0 + offset[0], 1.0 + offset[1])
         proj_matrix = get_projection_matrix(0, window_dimensions[0],
                                             0, window_dimensions[1])
         gl.glUniformMatrix4fv(self.uniform_locs['view_matrix'],
                               1, gl.GL_TRUE, view_matrix)
         gl.glUniformMatrix4fv(self.uniform_locs['proj_matrix'],
                               1, gl.GL_TRUE, proj_matrix)
-        model_matrix = get_4x4_transform(font_width, font_height,
-                                         offset[0], offset[1], 1.0)
-        gl.glUniformMatrix4fv(self.uniform_locs['model_matrix'], 1,
-                              gl.GL_TRUE, model_matrix)
-
-        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER,
-                        self.index_buffers['vert_indexes'])
-        gl.glDrawElements(gl.GL_TRIANGLES, len(self.indexes),
-                          gl.GL_UNSIGNED_INT, ctypes.c_void_p(0))
+        gl.glUniform2f(self.uniform_locs['glyph_size'], font_width,
+                       font_height)
+        gl.glUniform1ui(self.uniform_locs['scroll'], self.line)
+        gl.glDrawArraysInstanced(gl.GL_TRIANGLE_STRIP, 0, 4, self.filled)
@@ -0,0 +1,155 @@
+from string import Template
+from OpenGL import GL as gl
+from shader_filter import (ShaderFilter, FILTER_VERTICES,
+                           build_stage_source)
+import noise_pool
+from seeds import frame_rand
+
+VERT_SOURCE = """
+#version 330
+
+in vec2 vert_coord;
+in vec2 vert_tex_coord;
+out vec2 frag_tex_coord;
+
+void main()
+{
+  frag_tex_coord = vert_tex_coord;
+  gl_Position = vec4(vert_coord, 0.0, 1.0);
+}"""
+
+FRAG_TEMPLATE = """
+#version 330
+uniform sampler2D tex;
+uniform int frame;
+$rand_uniforms
+in vec2 frag_tex_coord;
+out vec4 frag_color;
+
+ivec2 texture_size;
+$noise_source
+vec4 filter_input(vec2 coord)
+{
+    return texture(tex, coord);
+}
+
+// What an unfused pass did to its output before the next pass read it:
+// blend over the clear color (glBlendFunc SRC_ALPHA, ONE_MINUS_SRC_ALPHA)
+// and store it in an 8 bit texture
+vec4 store_intermediate(vec4 c)
+{
+    vec4 clear_color = vec4(vec3(153.0 / 255.0), 0.0);
+    c = clamp(c, 0.0, 1.0);
+    c = c * c.a + clear_color * (1.0 - c.a);
+    return floor(c * 255.0 + 0.5) / 255.0;
+}
+
+// Nearest texel of the intermediate texture with GL_REPEAT wrapping
+ivec2 intermediate_texel(vec2 coord)
+{
+    ivec2 texel = ivec2(floor(coord * vec2(texture_size)));
+    return texel - texture_size *
+        ivec2(floor(vec2(texel) / vec2(texture_size)));
+}
+$stages
+
+void main()
+{
+    texture_size = textureSize(tex, 0);
+    frag_color = $last_stage(frag_tex_coord);
+}"""
+
+# Reads a stage's output the way the next unfused pass would have sampled it
+STAGE_INPUT_TEMPLATE = """
+vec4 ${name}(vec2 coord)
+{
+    vec2 texel_center = (vec2(intermediate_texel(coord)) + 0.5) /
+        vec2(texture_size);
+    return store_intermediate(${prev_stage}(texel_center));
+}
+"""
+
+
+def can_fuse(filters):
+    """
+    A stage can join the pass before it if it has a stage function and reads
+    its input once, otherwise the earlier stages would run once per read
+    """
+    return all(f.stage_source is not None for f in filters) and all(
+        f.input_samples == 1 for f in filters[1:])
+
+
+def split_fusable_runs(filters):
+    """
+    Split a chain into runs of filters that can be rendered as one pass,
+    keeping the chain order
+    """
+    runs = []
+    for f in filters:
+        if runs and can_fuse(runs[-1] + [f]):
+            runs[-1].append(f)
+        else:
+            runs.append([f])
+    return runs
+
+
+class FusedFilter(ShaderFilter):
+    """
+    Renders a run of filters in a single pass by calling each filter's stage
+    function on the previous one's output, instead of writing and reading
+    back an intermediate texture between them.
+    """
+    vert_source = VERT_SOURCE
+
+    def __init__(self, filters):
+        assert can_fuse(filters), "Error: filters can not be fused"
+        self.num_stages = len(filters)
+        self.deterministic = all(f.deterministic for f in filters)
+        self.frag_source = self.build_frag_source(filters)
+        self.attrib_locs = {
+            "vert_coord": -1,
+            "vert_tex_coord": -1,
+        }
+        self.uniform_locs = {"frame": -1, "noise_pool": -1}
+        for i in range(self.num_stages):
+            self.uniform_locs["rand_%d" % (i)] = -1
+        self.buffers = {
+            "vert_coord": -1,
+            "vert_tex_coord": -1,
+        }
+        self.init_shader()
+
+    def build_frag_source(self, filters):
+        stages = []
+        for i, f in enumerate(filters):
+            stage = "stage_%d" % (i)
+            if i == 0:
+                input = "filter_input"
+            else:
+                input = "%s_input" % (stage)
+                stages.append(Template(STAGE_INPUT_TEMPLATE).substitute(
+                    name=input, prev_stage="stage_%d" % (i - 1)))
+            stages.append(build_stage_source(f.stage_source, stage, input,
+                                             "rand_%d" % (i)))
+        rand_uniforms = "\n".join("uniform float rand_%d;" % (i)
+                                  for i in range(len(filters)))
+        return Template(FRAG_TEMPLATE).substitute(
+            noise_source=noise_pool.NOISE_SOURCE,
+            rand_uniforms=rand_uniforms, stages="\n".join(stages),
+            last_stage="stage_%d" % (len(filters) - 1))
+
+    def render(self, img_dimensions, frame, seed=0, index=0):
+        """
+        Render every stage at once, index is the first stage's place in the
+        chain. Each stage gets the rand its unfused pass would have had.
+        """
+        gl.glUseProgram(self.shader)
+        for i in range(self.num_stages):
+            if self.uniform_locs["rand_%d" % (i)] != -1:
+                gl.glUniform1f(self.uniform_locs["rand_%d" % (i)],
+                               frame_rand(seed, frame, index + i))
+        if self.uniform_locs['frame'] != -1:
+            gl.glUniform1iv(self.uniform_locs['frame'], 1, frame)
+        gl.glViewport(0, 0, img_dimensions[0], img_dimensions[1])
+        gl.glBindVertexArray(self.vao)
+        gl.glDrawArrays(gl.GL_TRIANGLES, 0, int(len(FILTER_VERTICES)/2/4))
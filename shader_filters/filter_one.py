@@ -1,4 +1,4 @@
-from shader_filter import ShaderFilter
+from shader_filter import ShaderFilter, build_frag_source
 
 VERT_SOURCE = """
 #version 330
@@ -13,35 +13,26 @@ void main()
   gl_Position = vec4(vert_coord, 0.0, 1.0);
 }"""
 
-FRAG_SOURCE = """
-#version 330
-uniform sampler2D tex;
-
-uniform float rand;
-uniform int frame;
-
-in vec2 frag_tex_coord;
-out vec4 frag_color;
-
-ivec2 texture_size;
-
-
-int add_target(int x, int target, int height)
+STAGE_SOURCE = """
+// Shifts x back 3 for every row boundary (target + j * width, j < height)
+// it is still past after the earlier shifts. Step j is taken while
+// x - 3j > target + j * width, i.e. the first ceil((x - target) /
+// (width + 3)) steps, so count them instead of looping. The float divide
+// is cheaper than an int one, the line after makes it exact.
+int ${stage}_add_target(int x, int target, int height)
 {
-    int i = x;
-    for(int j=0; j<height; j++) {
-        if(i > target + j * texture_size.x) {
-            i -= 3;
-        }
-    }
-    return i;
+    int d = x - target;
+    if(d <= 0)
+        return x;
+    int step = texture_size.x + 3;
+    int n = int(ceil(float(d) / float(step)));
+    n += int(n * step < d) - int((n - 1) * step >= d);
+    return x - 3 * min(height, n);
 }
 
 
-void main()
+vec4 ${stage}(vec2 frag_tex_coord)
 {
-    texture_size = textureSize(tex, 0);
-
     vec2 sub_pixel = vec2(1.0/texture_size.x/1000,
                           1.0/texture_size.y/1000);
 
@@ -53,13 +44,13 @@ void main()
 
     int i = coord.x + (texture_size.y - coord.y) * texture_size.x;
 
-    i = add_target(i,
+    i = ${stage}_add_target(i,
             texture_size.y / 7 *
             texture_size.x - texture_size.x * 20 +
             int(cos(float(frame * cos(float(frame)/3.9))/20.0) * 10.0) *
             texture_size.x, 20);
-    if(rand < 0.1)
-        i = add_target(i,
+    if(${rand} < 0.1)
+        i = ${stage}_add_target(i,
                 texture_size.y / 3 * texture_size.x - texture_size.x * 20 +
                 int(sin(float(frame)/30.0) *20.0) * texture_size.x, 15);
 
@@ -67,12 +58,15 @@ void main()
             vec2(float(i % texture_size.x) / texture_size.x,
                  1.0 - float(i / texture_size.x) / texture_size.y);
 
-    vec4 tex_color = texture(tex, new_tex_coord);
+    vec4 tex_color = ${input}(new_tex_coord);
 
-    frag_color = tex_color;
+    return tex_color;
 }"""
 
+FRAG_SOURCE = build_frag_source(STAGE_SOURCE)
+
 
 class FirstFilter(ShaderFilter):
     frag_source = FRAG_SOURCE
+    stage_source = STAGE_SOURCE
     vert_source = VERT_SOURCE
@@ -111,16 +111,7 @@ class OrthoFilter(ShaderFilter):
             "view_matrix": -1,
             "proj_matrix": -1,
         }
-        vert_prog = self._compile_shader(ORTH_VERT_SOURCE, gl.GL_VERTEX_SHADER)
-        frag_prog = self._compile_shader(
-            ORTH_FRAG_SOURCE, gl.GL_FRAGMENT_SHADER)
-        self.shader = gl.glCreateProgram()
-        gl.glAttachShader(self.shader, vert_prog)
-        gl.glAttachShader(self.shader, frag_prog)
-        gl.glLinkProgram(self.shader)
-        assert (gl.glGetProgramiv(self.shader, gl.GL_LINK_STATUS) ==
-                gl.GL_TRUE), (
-            "Error: %s" % (gl.glGetProgramInfoLog(self.shader)))
+        self.shader = self._create_program(ORTH_VERT_SOURCE, ORTH_FRAG_SOURCE)
 
         self.attrib_locs = {
             name: gl.glGetAttribLocation(self.shader, name)
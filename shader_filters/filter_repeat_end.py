@@ -1,4 +1,4 @@
-from shader_filter import ShaderFilter
+from shader_filter import ShaderFilter, build_frag_source
 
 VERT_SOURCE = """
 #version 330
@@ -13,31 +13,9 @@ void main()
   gl_Position = vec4(vert_coord, 0.0, 1.0);
 }"""
 
-FRAG_SOURCE = """
-#version 330
-uniform sampler2D tex;
-in vec2 frag_tex_coord;
-out vec4 frag_color;
-
-ivec2 texture_size;
-
-
-int add_target(int x, int target, int height)
+STAGE_SOURCE = """
+vec4 ${stage}(vec2 frag_tex_coord)
 {
-    int i = x;
-    for(int j=0; j<height; j++) {
-        if(i > target + j * texture_size.x) {
-            i -= 3;
-        }
-    }
-    return i;
-}
-
-
-void main()
-{
-    texture_size = textureSize(tex, 0);
-
     vec2 sub_pixel = vec2(1.0/texture_size.x/1000,
                           1.0/texture_size.y/1000);
 
@@ -52,12 +30,16 @@ void main()
 
     vec2 new_tex_coord = vec2(coord) / vec2(texture_size) + sub_pixel;
 
-    vec4 tex_color = texture(tex, new_tex_coord);
+    vec4 tex_color = ${input}(new_tex_coord);
 
-    frag_color = tex_color;
+    return tex_color;
 }"""
 
+FRAG_SOURCE = build_frag_source(STAGE_SOURCE)
+
 
 class RepeatEndFilter(ShaderFilter):
     frag_source = FRAG_SOURCE
+    stage_source = STAGE_SOURCE
+    deterministic = True
     vert_source = VERT_SOURCE
@@ -1,4 +1,4 @@
-from shader_filter import ShaderFilter
+from shader_filter import ShaderFilter, build_frag_source
 
 
 VERT_SOURCE = """
@@ -14,37 +14,9 @@ void main()
   gl_Position = vec4(vert_coord, 0.0, 1.0);
 }"""
 
-FRAG_SOURCE = """
-#version 330
-uniform sampler2D tex;
-
-uniform float rand;
-
-uniform int frame;
-
-in vec2 frag_tex_coord;
-out vec4 frag_color;
-
-ivec2 texture_size;
-
-
-int add_target(int x, int target)
+STAGE_SOURCE = """
+vec4 ${stage}(vec2 frag_tex_coord)
 {
-    int i = x;
-    for(int j=0; j<50; j++) {
-        if(i > target + j * texture_size.x) {
-
-            i -= 2;
-        }
-    }
-    return i;
-}
-
-
-void main()
-{
-    texture_size = textureSize(tex, 0);
-
     vec2 sub_pixel = vec2(1.0/texture_size.x/1000,
                           1.0/texture_size.y/1000);
 
@@ -79,13 +51,17 @@ void main()
     tex_coord_b = tex_coord_b * flip;
 
     // Get texture for each color channel, making sure to flip coord back
-    vec4 tex_color_r = texture(tex, tex_coord_r);
-    vec4 tex_color_g = texture(tex, tex_coord_g);
-    vec4 tex_color_b = texture(tex, tex_coord_b);
-    frag_color = vec4(tex_color_r.r, tex_color_g.g, tex_color_b.b, 1.0);
+    vec4 tex_color_r = ${input}(tex_coord_r);
+    vec4 tex_color_g = ${input}(tex_coord_g);
+    vec4 tex_color_b = ${input}(tex_coord_b);
+    return vec4(tex_color_r.r, tex_color_g.g, tex_color_b.b, 1.0);
 }"""
 
+FRAG_SOURCE = build_frag_source(STAGE_SOURCE)
+
 
 class RGBShiftFilter(ShaderFilter):
     vert_source = VERT_SOURCE
     frag_source = FRAG_SOURCE
+    stage_source = STAGE_SOURCE
+    input_samples = 3
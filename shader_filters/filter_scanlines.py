@@ -1,4 +1,4 @@
-from shader_filter import ShaderFilter
+from shader_filter import ShaderFilter, build_frag_source
 
 VERT_SOURCE = """
 #version 330
@@ -15,32 +15,14 @@ void main()
   gl_Position = vec4(vert_coord, 0.0, 1.0);
 }"""
 
-FRAG_SOURCE = """
-#version 330
-uniform sampler2D tex;
-uniform float rand;
-uniform int frame;
-in vec2 frag_tex_coord;
-out vec4 frag_color;
-
-ivec2 texture_size;
-
-float f_rand(vec2 co) {
-    co = co + rand;
-    return fract(
-        sin(
-            dot(co.xy, vec2(12.9898, 78.233))
-        ) * 43758.5453);
-}
-
-vec4 mix_colors(vec4 c1, vec4 c2) {
+STAGE_SOURCE = """
+vec4 ${stage}_mix_colors(vec4 c1, vec4 c2) {
     vec4 c = vec4(vec3(c1.rgb*c1.a + c2.rgb*c2.a), c1.a + c2.a);
     return c;
 }
 
-void main()
+vec4 ${stage}(vec2 frag_tex_coord)
 {
-    texture_size = textureSize(tex, 0);
     vec2 sub_pixel = vec2(1.0/texture_size.x/1000,
                           1.0/texture_size.y/1000);
 
@@ -65,7 +47,7 @@ void main()
 
     vec2 new_tex_coord = sub_pixel + vec2(tmp_coord) / vec2(texture_size);
 
-    vec4 tex_color = texture(tex, new_tex_coord);
+    vec4 tex_color = ${input}(new_tex_coord);
 
     if(coord.x % cell_width >= 0 &&
        coord.x % cell_width < 0 + color_width)
@@ -89,11 +71,15 @@ void main()
         tex_color *= 1.1;
         tex_color = clamp(tex_color, 0.0, 1.0);
     }
-    
-    frag_color = tex_color;
+
+    return tex_color;
 }"""
 
+FRAG_SOURCE = build_frag_source(STAGE_SOURCE)
+
 
 class ScanlineFilter(ShaderFilter):
     frag_source = FRAG_SOURCE
+    stage_source = STAGE_SOURCE
+    deterministic = True
     vert_source = VERT_SOURCE
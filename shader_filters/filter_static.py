@@ -1,4 +1,4 @@
-from shader_filter import ShaderFilter
+from shader_filter import ShaderFilter, build_frag_source
 
 VERT_SOURCE = """
 #version 330
@@ -15,28 +15,13 @@ void main()
   gl_Position = vec4(vert_coord, 0.0, 1.0);
 }"""
 
-FRAG_SOURCE = """
-#version 330
-uniform sampler2D tex;
-uniform float rand;
-uniform int frame;
-in vec2 frag_tex_coord;
-out vec4 frag_color;
-
-ivec2 texture_size;
-
-float f_rand(vec2 co) {
-    co = co + vec2(rand);
-    return fract(
-        sin(
-            dot(co.xy, vec2(12.9898, 78.233))
-        ) * 43758.5453);
+STAGE_SOURCE = """
+float ${stage}_f_rand(ivec2 co) {
+    return noise_at(co, ${rand});
 }
 
-void main()
+vec4 ${stage}(vec2 frag_tex_coord)
 {
-    texture_size = textureSize(tex, 0);
-
     vec2 sub_pixel = vec2(1.0/texture_size.x/1000.0,
                           1.0/texture_size.y/1000.0);
 
@@ -46,24 +31,27 @@ void main()
     vec2 coord_f = vec2(frag_tex_coord.x * float(texture_size.x),
                         frag_tex_coord.y * float(texture_size.y));
 
-    if(int(f_rand(ivec2(vec2(coord) / vec2(120, 3))) * 80) == 4) {
+    if(int(${stage}_f_rand(ivec2(vec2(coord) / vec2(120, 3))) * 80) == 4) {
 
-        frag_color = vec4(1.0, 1.0, 1.0, 1.0) *
+        return vec4(1.0, 1.0, 1.0, 1.0) *
         vec4(
-            f_rand(ivec2(vec2(3.14,3.14)+vec2(coord) / vec2(120, 3))),
-            f_rand(ivec2(vec2(3.14,3.14)+vec2(coord) / vec2(120,3))),
-            f_rand(ivec2(vec2(3.14,3.14)+vec2(coord) / vec2(120,3))), 1.0);
-        return;
+            ${stage}_f_rand(ivec2(vec2(3.14,3.14)+vec2(coord) / vec2(120, 3))),
+            ${stage}_f_rand(ivec2(vec2(3.14,3.14)+vec2(coord) / vec2(120,3))),
+            ${stage}_f_rand(ivec2(vec2(3.14,3.14)+vec2(coord) / vec2(120,3))),
+            1.0);
     }
     vec2 new_tex_coord = sub_pixel + vec2(coord) / vec2(texture_size);
 
 
-    vec4 tex_color = texture(tex, new_tex_coord);
+    vec4 tex_color = ${input}(new_tex_coord);
 
-    frag_color = tex_color;
+    return tex_color;
 }"""
 
+FRAG_SOURCE = build_frag_source(STAGE_SOURCE)
+
 
 class StaticFilter(ShaderFilter):
     frag_source = FRAG_SOURCE
+    stage_source = STAGE_SOURCE
     vert_source = VERT_SOURCE
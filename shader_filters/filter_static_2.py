@@ -1,4 +1,4 @@
-from shader_filter import ShaderFilter
+from shader_filter import ShaderFilter, build_frag_source
 
 VERT_SOURCE = """
 #version 330
@@ -15,28 +15,19 @@ void main()
   gl_Position = vec4(vert_coord, 0.0, 1.0);
 }"""
 
-FRAG_SOURCE = """
-#version 330
-uniform sampler2D tex;
-uniform float rand;
-uniform int frame;
-in vec2 frag_tex_coord;
-out vec4 frag_color;
-
-ivec2 texture_size;
+STAGE_SOURCE = """
+float ${stage}_f_rand(ivec2 co) {
+    return noise_at(co, ${rand});
+}
 
-float f_rand(vec2 co) {
-    co = co + rand;
-    return fract(
-        sin(
-            dot(co.xy, vec2(12.9898, 78.233))
-        ) * 43758.5453);
+// The band key's y is a cosine, it is quantized to 1/1000 steps to pick a
+// texel so neighbouring keys still get different noise
+float ${stage}_f_rand(vec2 co) {
+    return noise_at(ivec2(floor(co * vec2(1.0, 1000.0))), ${rand});
 }
 
-void main()
+vec4 ${stage}(vec2 frag_tex_coord)
 {
-    texture_size = textureSize(tex, 0);
-
     vec2 sub_pixel = vec2(1.0/texture_size.x/1000,
                           1.0/texture_size.y/1000);
 
@@ -48,21 +39,25 @@ void main()
 
     vec2 new_tex_coord = sub_pixel + vec2(coord) / vec2(texture_size);
 
-    vec4 tex_color = texture(tex, new_tex_coord);
+    vec4 tex_color = ${input}(new_tex_coord);
 
-    float r = f_rand(vec2(coord.x / int(100 * cos(cos(coord.y/3.0))),
+    float r = ${stage}_f_rand(vec2(coord.x / int(100 * cos(cos(coord.y/3.0))),
         cos(coord.y / 5))) * 10.0;
     if(r > 9.3)
     {
-        float c = f_rand(vec2(coord.x, coord.y) + vec2(rand, rand));
+        // offset so it doesn't reuse the band noise
+        float c = ${stage}_f_rand(coord + ivec2(0, texture_size.y));
         if(c > 0.3 && c < 0.8)
             tex_color = (tex_color / 4.0) + (vec4(c,c,c, 1.0) * 3.0 / 4.0);
     }
 
-    frag_color = tex_color;
+    return tex_color;
 }"""
 
+FRAG_SOURCE = build_frag_source(STAGE_SOURCE)
+
 
 class StaticFilter2(ShaderFilter):
     frag_source = FRAG_SOURCE
+    stage_source = STAGE_SOURCE
     vert_source = VERT_SOURCE
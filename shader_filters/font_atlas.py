@@ -0,0 +1,160 @@
+"""
+Raw console font atlas, a cache of the font rasterized at several sizes
+that loads without decoding an image.
+
+Layout, little endian:
+    header      magic "GLAT", version u16, number of sizes u16
+    per size    size, cell width, cell height, ascent, descent, atlas width,
+                atlas height (u16 each), pixel offset u32, 256 u8 advances
+    pixels      one byte of coverage per pixel, top row first, a 16x16 grid
+                of cells for chars 0 to 255
+
+The file is read with mmap, so only the pixels of the size in use are
+copied out of it.
+"""
+import mmap
+import os
+import struct
+
+ATLAS_MAGIC = b"GLAT"
+
+ATLAS_VERSION = 1
+
+ATLAS_PATH = 'font/font.atlas'
+
+FONT_PATH = 'font/RobotoMono-Bold.ttf'
+
+DEF_FONT_SIZE = 16
+
+DEF_SIZES = (12, 16, 20, 24, 32)
+
+HEADER = struct.Struct("<4sHH")
+
+SIZE_ENTRY = struct.Struct("<7HI256s")
+
+
+def cell_dimensions(size):
+    """
+    Cells keep the 10x20 proportions of the 16 px png atlas
+    """
+    return int(round(size * 10 / 16.0)), int(round(size * 20 / 16.0))
+
+
+def rasterize(font_path, size):
+    """
+    Returns the size entry values and the coverage pixels of font_path at
+    size, needs PIL
+    """
+    from PIL import Image, ImageDraw, ImageFont
+    fnt = ImageFont.truetype(font_path, size)
+    ascent, descent = fnt.getmetrics()
+    cell_w, cell_h = cell_dimensions(size)
+    img = Image.new("L", (cell_w * 16, cell_h * 16), color=0)
+    d = ImageDraw.Draw(img)
+    advances = bytearray(256)
+    for i in range(256):
+        char = chr(i)
+        d.text((i % 16 * cell_w, i // 16 * cell_h), char, font=fnt,
+               fill=255)
+        advances[i] = min(fnt.getsize(char)[0], 255)
+    pixels = img.tobytes()
+    entry = (size, cell_w, cell_h, ascent, descent, img.size[0],
+             img.size[1], bytes(advances))
+    img.close()
+    return entry, pixels
+
+
+def build_atlas(path=ATLAS_PATH, font_path=FONT_PATH, sizes=DEF_SIZES):
+    """
+    Rasterize every size and write the atlas to path
+    """
+    sizes = sorted(set(sizes))
+    rendered = [rasterize(font_path, size) for size in sizes]
+    offset = HEADER.size + SIZE_ENTRY.size * len(sizes)
+    entries = []
+    for entry, pixels in rendered:
+        entries.append(SIZE_ENTRY.pack(*(entry[:7] + (offset, entry[7]))))
+        offset += len(pixels)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(ATLAS_MAGIC, ATLAS_VERSION, len(sizes)))
+        for entry in entries:
+            f.write(entry)
+        for entry, pixels in rendered:
+            f.write(pixels)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def read_sizes(mapping):
+    """
+    Returns {size: (cell_w, cell_h, width, height, offset)} from the
+    header, ValueError when it isn't an atlas this version can read
+    """
+    if len(mapping) < HEADER.size:
+        raise ValueError("Font atlas is truncated")
+    magic, version, count = HEADER.unpack_from(mapping, 0)
+    if magic != ATLAS_MAGIC or version != ATLAS_VERSION:
+        raise ValueError("Not a version %s font atlas" % (ATLAS_VERSION))
+    sizes = {}
+    for i in range(count):
+        values = SIZE_ENTRY.unpack_from(mapping,
+                                        HEADER.size + SIZE_ENTRY.size * i)
+        size, cell_w, cell_h, ascent, descent, width, height, offset = (
+            values[:8])
+        if offset + width * height > len(mapping):
+            raise ValueError("Font atlas is truncated")
+        sizes[size] = (cell_w, cell_h, width, height, offset)
+    return sizes
+
+
+def map_atlas(path=ATLAS_PATH):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def atlas_sizes(path=ATLAS_PATH):
+    mapping = map_atlas(path)
+    try:
+        return set(read_sizes(mapping))
+    finally:
+        mapping.close()
+
+
+def load_atlas(size, path=ATLAS_PATH):
+    """
+    Returns ((width, height), pixels) of size, None when the atlas doesn't
+    have it
+    """
+    mapping = map_atlas(path)
+    try:
+        sizes = read_sizes(mapping)
+        if size not in sizes:
+            return None
+        cell_w, cell_h, width, height, offset = sizes[size]
+        return (width, height), mapping[offset:offset + width * height]
+    finally:
+        mapping.close()
+
+
+def get_atlas(size, path=ATLAS_PATH, font_path=FONT_PATH):
+    """
+    Load size from the atlas at path. The atlas is built first when it is
+    missing, older than the font or doesn't have size, keeping the sizes
+    it had.
+    """
+    sizes = set(DEF_SIZES)
+    if os.path.exists(path) and (
+            os.path.getmtime(path) >= os.path.getmtime(font_path)):
+        try:
+            atlas = load_atlas(size, path)
+            if atlas:
+                return atlas
+            sizes.update(atlas_sizes(path))
+        except ValueError:
+            # Empty, truncated or an older version, it is rebuilt
+            pass
+    sizes.add(size)
+    build_atlas(path, font_path, sizes)
+    return load_atlas(size, path)
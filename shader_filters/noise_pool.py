@@ -0,0 +1,72 @@
+from OpenGL import GL as gl
+from seeds import (generate_noise, NOISE_POOL_SIZE, NOISE_POOL_LAYERS,
+                   NOISE_POOL_SEED)
+
+# Texture unit the pool stays bound to, filters use unit 0 for their input
+NOISE_TEXTURE_UNIT = 1
+
+texture_id = -1
+
+# Set through configure, the defaults come from seeds
+pool_size = NOISE_POOL_SIZE
+
+pool_layers = NOISE_POOL_LAYERS
+
+pool_seed = NOISE_POOL_SEED
+
+# Sampled by stage functions through noise_at(ivec2 co, float rand), which
+# replaces evaluating a sin hash for every fragment
+NOISE_SOURCE = """
+uniform sampler2DArray noise_pool;
+
+float noise_at(ivec2 co, float rand)
+{
+    ivec3 size = textureSize(noise_pool, 0);
+    int seed = int(rand * 16777216.0);
+    ivec2 texel = co + ivec2(seed % size.x, (seed / size.x) % size.y);
+    texel = texel - size.xy * ivec2(floor(vec2(texel) / vec2(size.xy)));
+    return texelFetch(noise_pool, ivec3(texel, seed % size.z), 0).r;
+}
+"""
+
+
+def bind():
+    """
+    Create and upload the pool the first time, then keep it bound to
+    NOISE_TEXTURE_UNIT
+    """
+    global texture_id
+    if texture_id == -1:
+        texture_id = gl.glGenTextures(1)
+        gl.glActiveTexture(gl.GL_TEXTURE0 + NOISE_TEXTURE_UNIT)
+        gl.glBindTexture(gl.GL_TEXTURE_2D_ARRAY, texture_id)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_MAG_FILTER,
+                           gl.GL_NEAREST)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_MIN_FILTER,
+                           gl.GL_NEAREST)
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        gl.glTexImage3D(gl.GL_TEXTURE_2D_ARRAY, 0, gl.GL_R16,
+                        pool_size, pool_size, pool_layers, 0, gl.GL_RED,
+                        gl.GL_UNSIGNED_SHORT,
+                        generate_noise(pool_size, pool_layers, pool_seed))
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+
+
+def configure(size, layers, seed):
+    """
+    Change the pool. If it was already uploaded it is rebuilt and bound to
+    NOISE_TEXTURE_UNIT right away, programs built before keep their sampler
+    on that unit so they sample the new pool.
+    """
+    global pool_size, pool_layers, pool_seed
+    pool_size, pool_layers, pool_seed = size, layers, seed
+    if texture_id != -1:
+        cleanup()
+        bind()
+
+
+def cleanup():
+    global texture_id
+    if texture_id != -1:
+        gl.glDeleteTextures(int(texture_id))
+        texture_id = -1
@@ -0,0 +1,133 @@
+import ctypes
+import hashlib
+import os
+import struct
+from OpenGL import GL as gl
+from OpenGL.error import GLError
+
+# Linked program binaries are stored here, set IMAGE_GLITCH_SHADER_CACHE to
+# an empty string to always compile from source
+CACHE_DIR = os.environ.get(
+    'IMAGE_GLITCH_SHADER_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'image_glitch',
+                 'shaders'))
+
+# Counts since startup, used to report cold and warm start times
+stats = {
+    "hits": 0,
+    "misses": 0,
+    "rejected": 0,
+}
+
+_supported = None
+
+_driver_id = None
+
+
+def is_supported():
+    """
+    Program binaries need GL 4.1 or ARB_get_program_binary and at least
+    one binary format from the driver
+    """
+    global _supported
+    if _supported is None:
+        try:
+            _supported = (bool(CACHE_DIR) and
+                          bool(gl.glGetProgramBinary) and
+                          bool(gl.glProgramBinary) and
+                          gl.glGetIntegerv(
+                              gl.GL_NUM_PROGRAM_BINARY_FORMATS) > 0)
+        except Exception:
+            _supported = False
+    return _supported
+
+
+def _get_driver_id():
+    """
+    Binaries are only valid for the driver that made them
+    """
+    global _driver_id
+    if _driver_id is None:
+        _driver_id = b"\n".join(
+            gl.glGetString(name) or b""
+            for name in (gl.GL_VENDOR, gl.GL_RENDERER, gl.GL_VERSION))
+    return _driver_id
+
+
+def get_cache_path(vert_source, frag_source):
+    key = hashlib.sha1()
+    key.update(_get_driver_id())
+    for source in (vert_source, frag_source):
+        key.update(b"\0")
+        key.update(source.encode('utf-8'))
+    return os.path.join(CACHE_DIR, "%s.bin" % (key.hexdigest()))
+
+
+def load_program(vert_source, frag_source):
+    """
+    Returns a linked program from the cache or -1 if there is no usable
+    binary, rejected binaries are removed so they get rebuilt
+    """
+    if not is_supported():
+        return -1
+    path = get_cache_path(vert_source, frag_source)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        stats["misses"] += 1
+        return -1
+
+    program = -1
+    try:
+        binary_format = struct.unpack("<I", data[:4])[0]
+        binary = data[4:]
+        program = gl.glCreateProgram()
+        gl.glProgramBinary(program, binary_format, binary, len(binary))
+        linked = gl.glGetProgramiv(program, gl.GL_LINK_STATUS) == gl.GL_TRUE
+    except (struct.error, GLError):
+        # A truncated file or a binary format the driver dropped
+        linked = False
+    if not linked:
+        # Usually a driver update, fall back to compiling from source
+        if program != -1:
+            gl.glDeleteProgram(program)
+        stats["rejected"] += 1
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return -1
+    stats["hits"] += 1
+    return program
+
+
+def save_program(program, vert_source, frag_source):
+    """
+    Store the binary of a linked program. The program should have been
+    linked with GL_PROGRAM_BINARY_RETRIEVABLE_HINT set.
+    """
+    if not is_supported():
+        return
+    size = gl.glGetProgramiv(program, gl.GL_PROGRAM_BINARY_LENGTH)
+    if size <= 0:
+        return
+    length = gl.GLsizei(0)
+    binary_format = gl.GLenum(0)
+    binary = (ctypes.c_ubyte * size)()
+    gl.glGetProgramBinary(program, size, ctypes.byref(length),
+                          ctypes.byref(binary_format), binary)
+    path = get_cache_path(vert_source, frag_source)
+    # Write then rename so other processes never read a partial binary
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack("<I", binary_format.value))
+            f.write(ctypes.string_at(binary, length.value))
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        # The cache is only an optimization, a read only or racing cache
+        # dir just means compiling again next time
+        pass
@@ -1,8 +1,11 @@
 import ctypes
 from OpenGL import GL as gl
 from OpenGL.GL import shaders
-import random
 from array import array
+from string import Template
+import program_cache
+import noise_pool
+from seeds import frame_rand
 
 # Identity 4x4 matrix
 ORTH_VERTICES = [0.0, 0.0, 0.0, 1.0,
@@ -31,6 +34,51 @@ FILTER_VERTICES = [-1.0, -1.0,
                    1.0, 1.0]
 FILTER_VERTICES = array("f", FILTER_VERTICES).tostring()
 
+# Filters are written as a stage function so the same source can be used on
+# its own or fused with other stages into one shader (see filter_fused). A
+# stage source defines vec4 ${stage}(vec2 frag_tex_coord), reads its input
+# through ${input}(vec2) and its per draw random value from ${rand}. frame
+# and texture_size are shared by every stage, noise_at samples the noise pool.
+STAGE_FRAG_TEMPLATE = """
+#version 330
+uniform sampler2D tex;
+uniform float rand;
+uniform int frame;
+in vec2 frag_tex_coord;
+out vec4 frag_color;
+
+ivec2 texture_size;
+$noise_source
+vec4 filter_input(vec2 coord)
+{
+    return texture(tex, coord);
+}
+$stage_source
+
+void main()
+{
+    texture_size = textureSize(tex, 0);
+    frag_color = stage(frag_tex_coord);
+}"""
+
+
+def build_stage_source(stage_source, stage, input, rand):
+    """
+    Fill in the names used by a stage source
+    """
+    return Template(stage_source).substitute(stage=stage, input=input,
+                                             rand=rand)
+
+
+def build_frag_source(stage_source):
+    """
+    Creates the fragment shader for a filter used on its own
+    """
+    return Template(STAGE_FRAG_TEMPLATE).substitute(
+        noise_source=noise_pool.NOISE_SOURCE,
+        stage_source=build_stage_source(stage_source, "stage",
+                                        "filter_input", "rand"))
+
 
 class ShaderFilter:
     shader = -1  # Shader program
@@ -45,6 +93,7 @@ class ShaderFilter:
     uniform_locs = {
         "rand": -1,
         "frame": -1,
+        "noise_pool": -1,
     }
 
     # Buffer storage for vertex arrays
@@ -57,6 +106,13 @@ class ShaderFilter:
 
     vert_source = None  # vert shader source to be defined in derived classes
 
+    stage_source = None  # stage function, only filters with one can be fused
+
+    input_samples = 1  # times the stage reads its input per fragment
+
+    # Output depends only on the input, no frame or rand, so it can be cached
+    deterministic = False
+
     img = None
 
     def __init__(self):
@@ -81,17 +137,8 @@ class ShaderFilter:
         """
         Creates the filter shader that filters the imported image.
         """
-        vert_prog = self._compile_shader(self.vert_source, gl.GL_VERTEX_SHADER)
-        frag_prog = self._compile_shader(
-            self.frag_source, gl.GL_FRAGMENT_SHADER)
-
-        self.shader = gl.glCreateProgram()
-        gl.glAttachShader(self.shader, vert_prog)
-        gl.glAttachShader(self.shader, frag_prog)
-        gl.glLinkProgram(self.shader)
+        self.shader = self._create_program(self.vert_source, self.frag_source)
         gl.glUseProgram(self.shader)
-        assert (gl.glGetProgramiv(self.shader, gl.GL_LINK_STATUS) ==
-                gl.GL_TRUE), "Error: %s" % (gl.glGetProgramInfoLog(shader))
         self.attrib_locs = {
             name: gl.glGetAttribLocation(self.shader, name)
             for name in self.attrib_locs
@@ -100,6 +147,10 @@ class ShaderFilter:
             name: gl.glGetUniformLocation(self.shader, name)
             for name in self.uniform_locs
         }
+        if self.uniform_locs.get('noise_pool', -1) != -1:
+            noise_pool.bind()
+            gl.glUniform1i(self.uniform_locs['noise_pool'],
+                           noise_pool.NOISE_TEXTURE_UNIT)
 
         # Create vertex array for filter
         vao = gl.glGenVertexArrays(1)
@@ -125,19 +176,48 @@ class ShaderFilter:
                                  gl.GL_FLOAT, False, 0, ctypes.c_void_p(0))
         gl.glEnableVertexAttribArray(self.attrib_locs['vert_tex_coord'])
 
-    def render(self, img_dimensions, frame):
+    def render(self, img_dimensions, frame, seed=0, index=0):
         """
-        Render the shader output
+        Render the shader output, index is the filter's place in the chain
         """
         gl.glUseProgram(self.shader)
         if self.uniform_locs['rand'] != -1:
-            gl.glUniform1f(self.uniform_locs['rand'], random.random())
+            gl.glUniform1f(self.uniform_locs['rand'],
+                           frame_rand(seed, frame, index))
         if self.uniform_locs['frame'] != -1:
             gl.glUniform1iv(self.uniform_locs['frame'], 1, frame)
         gl.glViewport(0, 0, img_dimensions[0], img_dimensions[1])
         gl.glBindVertexArray(self.vao)
         gl.glDrawArrays(gl.GL_TRIANGLES, 0, int(len(FILTER_VERTICES)/2/4))
 
+    def _create_program(self, vert_source, frag_source):
+        """
+        Returns a linked program, loaded from the program binary cache when
+        the driver accepts the cached binary, otherwise compiled from source
+        and added to the cache
+        """
+        program = program_cache.load_program(vert_source, frag_source)
+        if program != -1:
+            return program
+
+        vert_prog = self._compile_shader(vert_source, gl.GL_VERTEX_SHADER)
+        frag_prog = self._compile_shader(frag_source, gl.GL_FRAGMENT_SHADER)
+        program = gl.glCreateProgram()
+        gl.glAttachShader(program, vert_prog)
+        gl.glAttachShader(program, frag_prog)
+        if program_cache.is_supported():
+            gl.glProgramParameteri(program,
+                                   gl.GL_PROGRAM_BINARY_RETRIEVABLE_HINT,
+                                   gl.GL_TRUE)
+        gl.glLinkProgram(program)
+        assert (gl.glGetProgramiv(program, gl.GL_LINK_STATUS) ==
+                gl.GL_TRUE), "Error: %s" % (gl.glGetProgramInfoLog(program))
+        # The linked program keeps what it needs
+        gl.glDeleteShader(vert_prog)
+        gl.glDeleteShader(frag_prog)
+        program_cache.save_program(program, vert_source, frag_source)
+        return program
+
     def _compile_shader(self, source, type):
         """
         gl.GL_VERTEX_SHADER or gl.GL_FRAGMENT_SHADER
@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+import time
+
+# Start tracing on startup and write the trace to this file when set
+TRACE_ENV = 'IMAGE_GLITCH_TRACE'
+
+DEF_TRACE_FILE = "trace.json"
+
+# Events past this are dropped so a forgotten trace can't eat all memory
+MAX_EVENTS = 1000000
+
+
+class _NullSpan:
+    """
+    Returned while tracing is off, entering and leaving it does nothing
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'cat', 'args', 'start')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add_span(self.name, self.cat, self.start, time.time(),
+                             self.args)
+        return False
+
+
+class Tracer:
+    """
+    Records spans of wall time as chrome trace events ("X" complete events)
+    and writes them as JSON that chrome://tracing or Perfetto can load.
+    While it is off span() hands back a shared no-op span, so the only cost
+    is the call.
+    """
+    enabled = False
+
+    filename = DEF_TRACE_FILE
+
+    # Why the last stop couldn't write the trace, None if it could
+    error = None
+
+    def __init__(self):
+        self.events = []
+        self.dropped = 0
+        self.origin = 0
+        self.lock = threading.Lock()
+
+    def start(self, filename=DEF_TRACE_FILE):
+        self.filename = filename
+        self.error = None
+        self.events = []
+        self.dropped = 0
+        self.origin = time.time()
+        self.enabled = True
+
+    def span(self, name, cat="run", args=None):
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name, cat, args)
+
+    def add_span(self, name, cat, start, end, args=None):
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": (start - self.origin) * 1000000.0,
+            "dur": (end - start) * 1000000.0,
+            "pid": os.getpid(),
+            "tid": threading.current_thread().ident,
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            if len(self.events) < MAX_EVENTS:
+                self.events.append(event)
+            else:
+                self.dropped += 1
+
+    def stop(self):
+        """
+        Stop tracing and write the trace, returns the number of events
+        written. If the file can't be written the events are dropped, error
+        says why and 0 is returned.
+        """
+        if not self.enabled:
+            return 0
+        self.enabled = False
+        with self.lock:
+            events = self.events
+            self.events = []
+        trace = {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"dropped_events": self.dropped},
+        }
+        try:
+            with open(self.filename, 'w') as f:
+                json.dump(trace, f)
+        except (IOError, OSError) as e:
+            self.error = e
+            return 0
+        return len(events)